@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+claim.py
+
+Measures claim latency against the number of concurrent claimants for
+ordered, random-token and partitioned claims.  Needs a running mongod, or
+--backend sqlite.  --sparse keeps the queue nearly empty instead, feeding it
+--rate jobs a second while the claimants poll, which is where every claimant
+would otherwise contend for the same few rows.
+
+    python benchmarks/claim.py --workers 1,8,32,128 --jobs 20000
+    python benchmarks/claim.py --workers 1,8,32,128 --jobs 2000 --sparse --rate 500
+"""
+
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import monque
+import pymongo
+
+MODES = dict(
+    ordered     = dict(ordered = True, claim_slots = None),
+    random      = dict(ordered = False, claim_slots = None),
+    partitioned = dict(ordered = False, claim_slots = 64),
+)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def new_monque(options, mode):
+    if options.backend == "sqlite":
+        storage = monque.SQLiteBackend(options.path)
+    else:
+        storage = pymongo.Connection(options.host)[options.db]
+
+    return monque.Monque(storage, claim_slots = MODES[mode]['claim_slots'])
+
+def claimant(options, mode, fed, results):
+    q = new_monque(options, mode)
+    latencies = []
+    claimed = 0
+
+    while True:
+        start = time.time()
+        row = q.pop("bench", ordered = MODES[mode]['ordered'])
+        latencies.append(time.time() - start)
+
+        if row is not None:
+            claimed += 1
+        elif fed.is_set() and not q.get_queue_collection("bench").count():
+            # a partitioned claim can come back empty while other slots
+            # still hold jobs
+            break
+
+    results.put((latencies, claimed))
+
+def feeder(options, mode, fed):
+    q = new_monque(options, mode)
+
+    for i in xrange(options.jobs):
+        q.push("bench", i)
+        time.sleep(1.0 / options.rate)
+
+    fed.set()
+
+def run(options, mode, workers):
+    q = new_monque(options, mode)
+    q.clear(["bench"])
+    fed = multiprocessing.Event()
+
+    if options.sparse:
+        children = [multiprocessing.Process(target = feeder, args = (options, mode, fed))]
+    else:
+        q.push_many("bench", [i for i in xrange(options.jobs)])
+        fed.set()
+        children = []
+
+    results = multiprocessing.Queue()
+    claimants = [multiprocessing.Process(target = claimant, args = (options, mode, fed, results)) for i in xrange(workers)]
+    children.extend(claimants)
+
+    start = time.time()
+    for child in children:
+        child.start()
+
+    latencies = []
+    claims = 0
+    for child in claimants:
+        polled, claimed = results.get()
+        latencies.extend(polled)
+        claims += claimed
+    elapsed = time.time() - start
+
+    for child in children:
+        child.join()
+
+    # with --sparse most polls come back empty, and their latency is
+    # what matters; otherwise only the last poll of each claimant is
+    return dict(
+        mode        = mode,
+        workers     = workers,
+        claims      = claims,
+        per_second  = claims / elapsed,
+        p50_ms      = percentile(latencies, 0.50) * 1000,
+        p99_ms      = percentile(latencies, 0.99) * 1000,
+    )
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--backend", default = "mongo", choices = ["mongo", "sqlite"])
+    parser.add_option("--host", default = "localhost")
+    parser.add_option("--db", default = "monque-bench")
+    parser.add_option("--path", default = os.path.join(tempfile.gettempdir(), "monque-bench.sqlite"), help = "sqlite file for --backend sqlite")
+    parser.add_option("--jobs", type = "int", default = 10000)
+    parser.add_option("--sparse", action = "store_true", help = "feed the queue while claiming instead of filling it first")
+    parser.add_option("--rate", type = "float", default = 500, help = "jobs a second fed with --sparse")
+    parser.add_option("--workers", default = "1,4,16,64")
+    parser.add_option("--modes", default = ",".join(sorted(MODES)))
+    options, args = parser.parse_args()
+
+    print "{0:<12} {1:>8} {2:>10} {3:>10} {4:>10}".format("mode", "workers", "claims/s", "p50 ms", "p99 ms")
+
+    for mode in options.modes.split(','):
+        for workers in [int(w) for w in options.workers.split(',')]:
+            r = run(options, mode, workers)
+            print "{mode:<12} {workers:>8} {per_second:>10.0f} {p50_ms:>10.2f} {p99_ms:>10.2f}".format(**r)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+suite.py
+
+End-to-end throughput and latency benchmark for enqueue, claim and the
+MonqueWorker loop.  Every combination of --producers, --workers, --payloads
+and --ordered is run against a fresh queue; results are printed and, with
+--output, written as JSON so that later runs can be checked with --compare.
+--backend runs it against a local mongod (the default), the in-memory
+backend, with producers and workers as threads of one process, or sqlite.
+
+    python benchmarks/suite.py --workers 1,8 --payloads 0,65536 --output before.json
+    python benchmarks/suite.py --workers 1,8 --payloads 0,65536 --compare before.json
+    python benchmarks/suite.py --backend memory
+"""
+
+import datetime
+import itertools
+import json
+import multiprocessing
+import multiprocessing.dummy
+import optparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import monque
+import pymongo
+
+QUEUE = "bench"
+_local = threading.local() # wait times, per consumer thread
+_memory = None
+
+
+@monque.job()
+def bench_job(enqueued_at, payload):
+    _local.waits.append(time.time() - enqueued_at)
+
+
+class BenchWorker(monque.MonqueWorker):
+    def __init__(self, *args, **kwargs):
+        super(BenchWorker, self).__init__(*args, **kwargs)
+        self.claims = []
+
+    def _next_order(self):
+        start = time.time()
+        order = super(BenchWorker, self)._next_order()
+        if order:
+            self.claims.append(time.time() - start)
+        return order
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def new_monque(options):
+    global _memory
+
+    if options.backend == "memory":
+        if _memory is None:
+            _memory = monque.MemoryBackend()
+        storage = _memory
+    elif options.backend == "sqlite":
+        storage = monque.SQLiteBackend(options.path)
+    else:
+        storage = pymongo.Connection(options.host)[options.db]
+
+    return monque.Monque(storage, default_queue = QUEUE)
+
+def producer(options, jobs, payload, results):
+    q = new_monque(options)
+    body = "x" * payload
+    start = time.time()
+
+    for i in xrange(jobs):
+        q.enqueue(bench_job(time.time(), body))
+
+    results.put(('enqueue', jobs, time.time() - start))
+
+def consumer(options, ordered, producers_done, results):
+    q = new_monque(options)
+    w = BenchWorker(q, queues = [QUEUE], dispatcher = "inline", ordered = ordered, reap = False)
+    w.register_worker()
+    _local.waits = []
+
+    while True:
+        if not w._work_once():
+            if producers_done.is_set() and not w._work_once():
+                break
+            time.sleep(0.001)
+
+    w._stats.flush()
+    w.unregister_worker()
+    results.put(('consume', _local.waits, w.claims))
+
+def run(options, producers, workers, payload, ordered):
+    new_monque(options).clear()
+
+    # the in-memory backend lives in this process, so share it between threads
+    concurrency = multiprocessing.dummy if options.backend == "memory" else multiprocessing
+    results = concurrency.Queue()
+    producers_done = concurrency.Event()
+    per_producer = options.jobs // producers
+
+    consumers = [concurrency.Process(target = consumer, args = (options, ordered, producers_done, results)) for i in xrange(workers)]
+    feeders = [concurrency.Process(target = producer, args = (options, per_producer, payload, results)) for i in xrange(producers)]
+
+    start = time.time()
+    for child in consumers + feeders:
+        child.start()
+
+    enqueue_rates, waits, claims = [], [], []
+
+    for i in xrange(producers):
+        kind, jobs, elapsed = results.get()
+        enqueue_rates.append(jobs / elapsed)
+    producers_done.set()
+
+    for i in xrange(workers):
+        kind, consumer_waits, consumer_claims = results.get()
+        waits.extend(consumer_waits)
+        claims.extend(consumer_claims)
+    elapsed = time.time() - start
+
+    for child in consumers + feeders:
+        child.join()
+
+    return dict(
+        producers       = producers,
+        workers         = workers,
+        payload         = payload,
+        ordered         = ordered,
+        jobs            = len(waits),
+        jobs_per_sec    = len(waits) / elapsed,
+        enqueue_per_sec = sum(enqueue_rates),
+        wait_p50_ms     = percentile(waits, 0.50) * 1000,
+        wait_p99_ms     = percentile(waits, 0.99) * 1000,
+        claim_p50_ms    = percentile(claims, 0.50) * 1000,
+        claim_p99_ms    = percentile(claims, 0.99) * 1000,
+    )
+
+def config_key(r):
+    return (r['producers'], r['workers'], r['payload'], r['ordered'])
+
+def report(runs, baseline=None):
+    columns = ("producers", "workers", "payload", "ordered", "jobs_per_sec", "enqueue_per_sec", "wait_p50_ms", "wait_p99_ms", "claim_p50_ms", "claim_p99_ms")
+    print " ".join("{0:>15}".format(c) for c in columns)
+
+    previous = dict((config_key(r), r) for r in (baseline or []))
+
+    for r in runs:
+        print " ".join("{0:>15}".format(round(r[c], 2) if isinstance(r[c], float) else r[c]) for c in columns)
+
+        if config_key(r) in previous:
+            old = previous[config_key(r)]
+            print " ".join("{0:>15}".format("" if c not in old or not isinstance(r[c], float) else "{0:+.1f}%".format((r[c] - old[c]) * 100.0 / (old[c] or 1))) for c in columns)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--backend", default = "mongo", choices = ["mongo", "memory", "sqlite"])
+    parser.add_option("--host", default = "localhost")
+    parser.add_option("--db", default = "monque-bench")
+    parser.add_option("--path", default = os.path.join(tempfile.gettempdir(), "monque-bench.sqlite"), help = "sqlite file for --backend sqlite")
+    parser.add_option("--jobs", type = "int", default = 5000)
+    parser.add_option("--producers", default = "1")
+    parser.add_option("--workers", default = "1,4")
+    parser.add_option("--payloads", default = "0,4096")
+    parser.add_option("--ordered", default = "true,false")
+    parser.add_option("--output", help = "write results as JSON to this file")
+    parser.add_option("--compare", help = "show changes against a JSON file from an earlier --output")
+    options, args = parser.parse_args()
+
+    matrix = itertools.product(
+        [int(p) for p in options.producers.split(',')],
+        [int(w) for w in options.workers.split(',')],
+        [int(p) for p in options.payloads.split(',')],
+        [o.strip().lower() == "true" for o in options.ordered.split(',')],
+    )
+    runs = [run(options, *config) for config in matrix]
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['runs']
+
+    report(runs, baseline)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(dict(
+                version     = monque.__version__,
+                hostname    = socket.gethostname(),
+                time        = datetime.datetime.utcnow().isoformat(),
+                runs        = runs,
+            ), f, indent = 2)
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,10 @@ Created by Kurtiss Hare on 2010-03-12.
 
 from version import VERSION
 from base import Monque
+from backends import MemoryBackend, MongoBackend, SQLiteBackend
 from worker import MonqueWorker
-from job import MonqueJob, job
+from async_worker import AsyncMonqueWorker
+from job import MonqueJob, MonqueBatchJob, job, batch_job
+from result import MonqueResult, MonqueJobFailed, MonqueResultTimeout
 
 __version__ = VERSION
\ No newline at end of file
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+async_worker.py
+"""
+
+import util
+import worker
+
+try:
+    import gevent
+    import gevent.event
+    import gevent.pool
+except ImportError:
+    gevent = None
+
+
+class AsyncMonqueWorker(worker.MonqueWorker):
+    # runs up to `concurrency` jobs at once as greenlets on a single gevent
+    # hub.  jobs and the mongo driver only yield to each other once the
+    # process has called gevent.monkey.patch_all(), so do that before the
+    # connection is created.
+
+    def __init__(self, monque, queues=None, concurrency=100, **kwargs):
+        if gevent is None:
+            raise ImportError("AsyncMonqueWorker requires gevent.")
+
+        kwargs['dispatcher'] = "gevent"
+        kwargs['concurrency'] = concurrency
+        super(AsyncMonqueWorker, self).__init__(monque, queues, **kwargs)
+        self._wakeup = gevent.event.Event()
+        self._heartbeat_stop = gevent.event.Event()
+        self._heartbeat_greenlet = None
+
+    def work(self, interval=5):
+        self.preload()
+        self.register_worker()
+        self._register_signal_handlers()
+        self._monque.buffer_counts(self._stats)
+        self._start_heartbeat()
+
+        util.setprocname("monque: Running up to {0} greenlets on queues: {1}".format(self._concurrency, ','.join(self._queues)))
+
+        group = gevent.pool.Pool(self._concurrency)
+
+        try:
+            while not self._shutdown_status:
+                if group.full():
+                    if interval == 0:
+                        break
+                    group.wait_available()
+                    continue
+
+                order = self._next_order()
+
+                if order:
+                    group.spawn(self._run_order, order)
+                    continue
+
+                if interval == 0:
+                    break
+
+                self._idle(interval)
+        finally:
+            if self._shutdown_status == "immediate":
+                group.kill()
+            else:
+                group.join()
+
+            self._stop_heartbeat()
+            self.release_prefetched()
+            self._monque.buffer_counts(None)
+            self._stats.flush()
+            self.unregister_worker()
+
+    def _start_heartbeat(self):
+        # a greenlet rather than a thread, so that the gevent event stopping
+        # it actually wakes it
+        self._heartbeat_stop.clear()
+        self._heartbeat_greenlet = gevent.spawn(self._heartbeat_target)
+
+    def _stop_heartbeat(self):
+        self._heartbeat_stop.set()
+        self._heartbeat_greenlet.join()
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+__init__.py
+"""
+
+from base import MonqueBackend
+from memory import MemoryBackend
+from mongo import MongoBackend
+from sqlite import SQLiteBackend
+
+
+def get_backend(storage):
+    if isinstance(storage, MonqueBackend):
+        return storage
+    return MongoBackend(storage)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+base.py
+"""
+
+import abc
+import pymongo.binary
+from pymongo.objectid import ObjectId
+
+
+class MonqueBackend(object):
+    # storage under a Monque and its workers.  collections returned by a
+    # backend behave like pymongo collections for the calls monque makes:
+    # insert, update (with $set, $unset, $inc and $push, upsert and multi),
+    # remove, find (spec, fields, sort, limit, tailable), find_one, count and
+    # ensure_index (including unique indexes), plus a `name` attribute.
+    # write-concern keyword arguments are accepted and ignored where they
+    # have no meaning, and so are read preferences: only a backend with a
+    # separate secondary returns anything else from secondary_collection.
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def collection(self, name):
+        pass
+
+    def secondary_collection(self, name):
+        return self.collection(name)
+
+    @abc.abstractmethod
+    def capped_collection(self, name, size):
+        pass
+
+    @abc.abstractmethod
+    def collection_names(self):
+        pass
+
+    @abc.abstractmethod
+    def find_and_modify(self, collection, query, sort=None, update=None, remove=False, **write_concern):
+        # atomically picks the first document matching query in sort order
+        # and either applies update to it or removes it.  returns the
+        # document as it was before modification, or None.
+        pass
+
+    # blobs too big to keep inline, one document each in the collection
+    # `name` unless the backend has something better suited
+
+    def put_blob(self, name, data):
+        _id = ObjectId()
+        self.collection(name).insert(dict(_id = _id, data = pymongo.binary.Binary(data)))
+        return _id
+
+    def get_blob(self, name, blob_id):
+        doc = self.collection(name).find_one(dict(_id = blob_id))
+        return None if doc is None else str(doc['data'])
+
+    def delete_blob(self, name, blob_id):
+        self.collection(name).remove(dict(_id = blob_id))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+memory.py
+"""
+
+import base
+import bisect
+import collections
+import copy
+import itertools
+import pymongo.errors
+import query
+import sys
+import threading
+from pymongo.objectid import ObjectId
+
+_lower = ('$gt', '$gte')
+_upper = ('$lt', '$lte')
+
+
+class MemoryBackend(base.MonqueBackend):
+    # keeps everything in process memory.  all collections share one lock,
+    # held only for the few dictionary operations of each call, which is
+    # what makes claims atomic between a worker's threads.  nothing is shared
+    # between processes, so pair it with the "threads" or "gevent"
+    # dispatchers rather than separate worker processes.
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._collections = dict()
+        self._sequence = itertools.count(1)
+
+    def collection(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def capped_collection(self, name, size):
+        c = self.collection(name)
+        # capped collections are sized in bytes; assume small documents
+        c.max_documents = max(1, size // 128)
+        return c
+
+    def collection_names(self):
+        return [name for (name, c) in self._collections.items() if c.count()]
+
+    def find_and_modify(self, collection, query, sort=None, update=None, remove=False, **write_concern):
+        return collection.find_and_modify(query, sort, update, remove)
+
+
+class MemoryCollection(object):
+    def __init__(self, backend, name):
+        self.name = name
+        self.max_documents = None
+        self._backend = backend
+        self._lock = backend._lock
+        self._documents = collections.OrderedDict()
+        self._sequence = dict()
+        self._unique = dict()
+        self._sorted = dict()
+        self._ttl = None
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+
+        with self._lock:
+            self._expire()
+
+            for doc in docs:
+                doc.setdefault('_id', ObjectId())
+                self._check_unique(doc)
+                self._documents[doc['_id']] = stored = copy.deepcopy(doc)
+                self._sequence[doc['_id']] = self._backend._sequence.next()
+                self._index(stored)
+
+            if self.max_documents:
+                while len(self._documents) > self.max_documents:
+                    self._delete(next(iter(self._documents)))
+
+        ids = [doc['_id'] for doc in docs]
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        with self._lock:
+            updated = 0
+
+            for doc in self._matching(spec):
+                self._modify(doc, document)
+                updated += 1
+
+                if not multi:
+                    break
+
+            if not updated and upsert:
+                self.insert(query.upsert_document(spec, document))
+
+    def remove(self, spec_or_id=None, **kwargs):
+        with self._lock:
+            for doc in list(self._matching(query.id_spec(spec_or_id))):
+                self._delete(doc['_id'])
+
+    def find(self, spec=None, fields=None, sort=None, limit=0, tailable=False, **kwargs):
+        if tailable:
+            return MemoryTailableCursor(self, spec)
+
+        with self._lock:
+            if sort and limit and query.normalize_sort(sort)[0][0] != '$natural':
+                docs = list(itertools.islice(self._ordered(spec, sort), limit))
+            else:
+                docs = query.sort_documents(list(self._matching(spec)), sort)
+
+                if limit:
+                    docs = docs[:limit]
+
+            return query.Cursor([query.project(copy.deepcopy(doc), fields) for doc in docs])
+
+    def find_one(self, spec_or_id=None, **kwargs):
+        for doc in self.find(query.id_spec(spec_or_id), limit=1, **kwargs):
+            return doc
+
+    def count(self):
+        return len(self._documents)
+
+    def ensure_index(self, key_or_list, unique=False, sparse=False, expireAfterSeconds=None, **kwargs):
+        keys = query.index_keys(key_or_list)
+
+        with self._lock:
+            if expireAfterSeconds is not None:
+                self._ttl = query.Expiry(keys[0], expireAfterSeconds)
+
+            if unique and (keys, sparse) not in self._unique:
+                self._unique[(keys, sparse)] = dict()
+                for doc in self._documents.itervalues():
+                    self._check_unique(doc)
+                    self._index_unique(doc)
+
+    def find_and_modify(self, spec, sort=None, update=None, remove=False):
+        with self._lock:
+            if sort:
+                doc = next(self._ordered(spec, sort), None)
+            else:
+                doc = next(self._matching(spec), None)
+
+            if doc is None:
+                return None
+
+            original = copy.deepcopy(doc)
+
+            if remove:
+                self._delete(doc['_id'])
+            else:
+                self._modify(doc, update)
+
+            return original
+
+    def _modify(self, doc, update):
+        modified = copy.deepcopy(doc)
+        query.apply_update(modified, update)
+        self._check_unique(modified)
+        self._unindex(doc)
+        doc.clear()
+        doc.update(modified)
+        self._index(doc)
+
+    def _expire(self):
+        expired = self._ttl and self._ttl.due()
+
+        if expired:
+            for doc in list(self._matching(expired)):
+                self._delete(doc['_id'])
+
+    def _delete(self, _id):
+        self._unindex(self._documents.pop(_id))
+        del self._sequence[_id]
+
+    def _matching(self, spec):
+        spec = spec or dict()
+
+        if '_id' in spec and not query.is_operator_dict(spec['_id']):
+            doc = self._documents.get(spec['_id'])
+            candidates = [doc] if doc else []
+        elif '_id' in spec and spec['_id'].keys() == ['$in']:
+            ids = collections.OrderedDict.fromkeys(spec['_id']['$in'])
+            candidates = [self._documents[_id] for _id in ids if _id in self._documents]
+        else:
+            candidates = list(self._documents.itervalues())
+
+        return (doc for doc in candidates if query.matches(doc, spec))
+
+    def _ordered(self, spec, sort):
+        # the documents matching spec in sort order, walked off an index kept
+        # in that order, so that claims stop at the first match instead of
+        # sorting the whole collection.  a range on the leading sort key
+        # picks where the walk starts and where it can stop.
+        spec = spec or dict()
+        sort = tuple(query.normalize_sort(sort))
+        entries = self._sorted_index(sort)
+        key, direction = sort[0]
+        cond = spec.get(key)
+        bounded = query.is_operator_dict(cond) and all(op in _lower + _upper for op in cond)
+        position = 0
+
+        if bounded:
+            for op, arg in cond.iteritems():
+                if (op in _lower) == (direction > 0):
+                    inclusive = op in ('$gte', '$lte')
+                    probe = (_SortKey.probe(arg, sort), -1 if inclusive else sys.maxint)
+                    position = max(position, bisect.bisect_left(entries, probe))
+
+        # by position rather than over a copy of the index; callers stop
+        # walking before they modify anything
+        while position < len(entries):
+            doc = self._documents[entries[position][2]]
+            position += 1
+
+            if bounded and query.get_path(doc, key) not in (query._missing, None) and not query.matches(doc, {key : cond}):
+                break
+
+            if query.matches(doc, spec):
+                yield doc
+
+    def _sorted_index(self, sort):
+        if sort not in self._sorted:
+            self._sorted[sort] = sorted(self._sorted_entry(doc, sort) for doc in self._documents.itervalues())
+        return self._sorted[sort]
+
+    def _sorted_entry(self, doc, sort):
+        return (_SortKey(doc, sort), self._sequence[doc['_id']], doc['_id'])
+
+    def _unique_entries(self, doc):
+        for (keys, sparse), entries in self._unique.iteritems():
+            values = [query.get_path(doc, k) for k in keys]
+
+            if sparse and all(v is query._missing for v in values):
+                continue
+
+            yield keys, entries, repr([None if v is query._missing else v for v in values])
+
+    def _check_unique(self, doc):
+        for keys, entries, value in self._unique_entries(doc):
+            if entries.get(value, doc['_id']) != doc['_id']:
+                raise pymongo.errors.DuplicateKeyError("E11000 duplicate key error on {0} {1}".format(self.name, keys))
+
+    def _index(self, doc):
+        self._index_unique(doc)
+
+        for sort, entries in self._sorted.iteritems():
+            bisect.insort(entries, self._sorted_entry(doc, sort))
+
+    def _index_unique(self, doc):
+        for keys, entries, value in self._unique_entries(doc):
+            entries[value] = doc['_id']
+
+    def _unindex(self, doc):
+        for keys, entries, value in self._unique_entries(doc):
+            entries.pop(value, None)
+
+        for sort, entries in self._sorted.iteritems():
+            entry = self._sorted_entry(doc, sort)
+            del entries[bisect.bisect_left(entries, entry)]
+
+
+
+class _SortKey(object):
+    # a document's place under a sort, compared the way sort_documents orders
+    # documents: missing values first, then by value, each key in its direction
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, doc, sort):
+        self.values = tuple(self._value(query.get_path(doc, key)) for (key, direction) in sort)
+        self.directions = tuple(direction for (key, direction) in sort)
+
+    @classmethod
+    def probe(cls, value, sort):
+        # compares equal to every key with `value` under the leading sort key
+        probe = cls.__new__(cls)
+        probe.values = (cls._value(value),)
+        probe.directions = tuple(direction for (key, direction) in sort[:1])
+        return probe
+
+    @staticmethod
+    def _value(value):
+        return (0, None) if value is query._missing or value is None else (1, value)
+
+    def __cmp__(self, other):
+        for a, b, direction in zip(self.values, other.values, self.directions):
+            c = cmp(a, b)
+            if c:
+                return c if direction > 0 else -c
+        return 0
+
+
+class MemoryTailableCursor(query.TailableCursor):
+    def _after(self, position):
+        c = self._collection
+
+        with c._lock:
+            found = [(c._sequence[_id], doc) for (_id, doc) in c._documents.iteritems() if c._sequence[_id] > position]
+
+        return [(sequence, copy.deepcopy(doc)) for (sequence, doc) in found]
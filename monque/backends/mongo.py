@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+mongo.py
+"""
+
+import base
+import gridfs
+import pymongo.errors
+import pymongo.son
+
+
+class MongoBackend(base.MonqueBackend):
+    # secondary is an optional database handle on a slave_okay connection,
+    # used for the reads a Monque's read_preferences send to secondaries.
+
+    def __init__(self, mongodb, secondary=None):
+        self.mongodb = mongodb
+        self.secondary = secondary
+
+    def collection(self, name):
+        return self.mongodb[name]
+
+    def secondary_collection(self, name):
+        if self.secondary is None:
+            return self.collection(name)
+        return self.secondary[name]
+
+    def capped_collection(self, name, size):
+        try:
+            self.mongodb.create_collection(name, capped=True, size=size)
+        except pymongo.errors.CollectionInvalid:
+            pass # Already created
+
+        return self.mongodb[name]
+
+    def collection_names(self):
+        return self.mongodb.collection_names()
+
+    def find_and_modify(self, collection, query, sort=None, update=None, remove=False, **write_concern):
+        command = [
+            ('findandmodify', collection.name),
+            ('query', query),
+        ]
+
+        if sort:
+            command.append(('sort', sort))
+
+        if remove:
+            command.append(('remove', True))
+        else:
+            command.append(('update', update))
+
+        try:
+            result = self.mongodb.command(pymongo.son.SON(command))
+        except pymongo.errors.OperationFailure:
+            return None # No matching object found
+
+        # the command is always acknowledged; anything stronger than that,
+        # such as w or j, waits on getlasterror over the same socket.
+        options = dict((k, v) for (k, v) in write_concern.iteritems() if k != 'safe')
+
+        if options and write_concern.get('safe', True):
+            self.mongodb.command('getlasterror', **options)
+
+        return result.get('value')
+
+    # blobs go to GridFS, so that they are not bound by the document size
+    # limit
+
+    def put_blob(self, name, data):
+        return gridfs.GridFS(self.mongodb, name).put(data)
+
+    def get_blob(self, name, blob_id):
+        try:
+            return gridfs.GridFS(self.mongodb, name).get(blob_id).read()
+        except gridfs.errors.NoFile:
+            return None
+
+    def delete_blob(self, name, blob_id):
+        gridfs.GridFS(self.mongodb, name).delete(blob_id)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+query.py
+
+The subset of MongoDB query, update, sort and projection semantics that monque
+itself relies on, for the backends that are not MongoDB.
+"""
+
+import copy
+import datetime
+import time
+
+_missing = object()
+
+
+def get_path(doc, key):
+    for part in key.split('.'):
+        if isinstance(doc, dict) and part in doc:
+            doc = doc[part]
+        else:
+            return _missing
+    return doc
+
+def _parent(doc, key):
+    parts = key.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, dict())
+    return doc, parts[-1]
+
+def _equals(value, expected):
+    if value is _missing:
+        return expected is None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+def _compare(op):
+    def compare(value, arg):
+        if value is _missing or value is None:
+            return False
+        try:
+            return op(value, arg)
+        except TypeError:
+            return False
+    return compare
+
+_operators = {
+    '$lt'       : _compare(lambda a, b: a < b),
+    '$lte'      : _compare(lambda a, b: a <= b),
+    '$gt'       : _compare(lambda a, b: a > b),
+    '$gte'      : _compare(lambda a, b: a >= b),
+    '$ne'       : lambda value, arg: not _equals(value, arg),
+    '$in'       : lambda value, arg: any(_equals(value, a) for a in arg),
+    '$nin'      : lambda value, arg: not any(_equals(value, a) for a in arg),
+    '$exists'   : lambda value, arg: (value is not _missing) == bool(arg),
+}
+
+def is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond)
+
+def matches(doc, spec):
+    for key, cond in (spec or dict()).iteritems():
+        if key == '$or':
+            if not any(matches(doc, s) for s in cond):
+                return False
+            continue
+
+        value = get_path(doc, key)
+
+        if is_operator_dict(cond):
+            for op, arg in cond.iteritems():
+                if not _operators[op](value, arg):
+                    return False
+        elif not _equals(value, cond):
+            return False
+
+    return True
+
+def apply_update(doc, update):
+    if not any(k.startswith('$') for k in update):
+        _id = doc['_id']
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        doc['_id'] = _id
+        return
+
+    for op, fields in update.iteritems():
+        for key, value in fields.iteritems():
+            parent, last = _parent(doc, key)
+
+            if op == '$set':
+                parent[last] = copy.deepcopy(value)
+            elif op == '$unset':
+                parent.pop(last, None)
+            elif op == '$inc':
+                parent[last] = parent.get(last, 0) + value
+            elif op == '$push':
+                parent.setdefault(last, []).append(copy.deepcopy(value))
+            else:
+                raise ValueError("Unsupported update operator: {0}".format(op))
+
+def upsert_document(spec, update):
+    doc = dict((k, copy.deepcopy(v)) for (k, v) in spec.iteritems() if not k.startswith('$') and not is_operator_dict(v))
+    apply_update(doc, update) if any(k.startswith('$') for k in update) else doc.update(copy.deepcopy(update))
+    return doc
+
+def normalize_sort(sort):
+    if not sort:
+        return []
+    if hasattr(sort, 'items'):
+        return sort.items()
+    return list(sort)
+
+def sort_documents(docs, sort):
+    # repeated stable sorts, least significant key first; missing values sort
+    # before everything else, as they do in MongoDB.  backends hand documents
+    # over in insertion order, which is what $natural sorts by.
+    for key, direction in reversed(normalize_sort(sort)):
+        if key == '$natural':
+            if direction < 0:
+                docs.reverse()
+            continue
+
+        def sort_key(doc, key=key):
+            value = get_path(doc, key)
+            return (0, None) if value is _missing or value is None else (1, value)
+        docs.sort(key=sort_key, reverse=direction < 0)
+    return docs
+
+def project(doc, fields):
+    if not fields:
+        return doc
+    if hasattr(fields, 'items'):
+        fields = [k for (k, v) in fields.items() if v]
+
+    projected = dict((k, doc[k]) for k in fields if k in doc)
+    projected['_id'] = doc['_id']
+    return projected
+
+class Cursor(list):
+    # the results of a find, with pymongo's cursor count()
+    def count(self, with_limit_and_skip=False):
+        return len(self)
+
+def index_keys(key_or_list):
+    if isinstance(key_or_list, basestring):
+        return (key_or_list,)
+    return tuple(k for (k, direction) in key_or_list)
+
+def id_spec(spec_or_id):
+    if spec_or_id is None or isinstance(spec_or_id, dict):
+        return spec_or_id
+    return dict(_id = spec_or_id)
+
+class Expiry(object):
+    # a TTL index.  like mongod's TTL monitor, documents are swept out at
+    # most once a minute: due() returns the spec of the expired documents
+    # when a sweep is due, and None otherwise.
+    def __init__(self, key, seconds):
+        self.key = key
+        self.seconds = seconds
+        self._next = 0
+
+    def due(self):
+        if time.time() < self._next:
+            return None
+
+        self._next = time.time() + 60
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.seconds)
+        return {self.key : {'$lt' : cutoff}}
+
+class TailableCursor(object):
+    # yields the documents matching spec inserted after the last one seen;
+    # backends supply _after(position), the (position, document) pairs
+    # inserted since, in insertion order
+    alive = True
+
+    def __init__(self, collection, spec):
+        self._collection = collection
+        self._spec = spec or dict()
+        self._position = 0
+
+    def __iter__(self):
+        for position, doc in self._after(self._position):
+            self._position = position
+
+            if matches(doc, self._spec):
+                yield doc
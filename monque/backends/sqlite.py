@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+sqlite.py
+"""
+
+import base
+import calendar
+import copy
+import cPickle
+import datetime
+import os
+import pymongo.errors
+import query
+import sqlite3
+import threading
+from pymongo.objectid import ObjectId
+
+# document fields copied into indexed columns so that the common claim,
+# lease and lookup queries are narrowed down by sqlite before the remaining
+# conditions are checked in python.
+_COLUMNS = ('scheduled_time', 'lease', 'lease_owner', 'queue', 'unique_key')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    seq             INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection      TEXT NOT NULL,
+    id              TEXT NOT NULL,
+    scheduled_time  REAL,
+    lease           TEXT,
+    lease_owner     TEXT,
+    queue           TEXT,
+    unique_key      TEXT,
+    doc             BLOB NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS documents_id ON documents (collection, id);
+CREATE INDEX IF NOT EXISTS documents_scheduled_time ON documents (collection, scheduled_time);
+CREATE INDEX IF NOT EXISTS documents_lease ON documents (collection, lease);
+CREATE INDEX IF NOT EXISTS documents_lease_owner ON documents (collection, lease_owner);
+CREATE INDEX IF NOT EXISTS documents_queue ON documents (collection, queue, scheduled_time);
+CREATE INDEX IF NOT EXISTS documents_unique_key ON documents (collection, unique_key);
+"""
+
+
+def _column_value(value):
+    if value is None or value is query._missing:
+        return None
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return unicode(value)
+
+
+class SQLiteBackend(base.MonqueBackend):
+    # a single sqlite file in WAL mode, shared safely between the threads and
+    # processes of one host.  every write is its own IMMEDIATE transaction, so
+    # claims are atomic across processes too.
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._collections = dict()
+        self._capped = dict()
+        self._unique = dict()
+        self._ttl = dict()
+        self._lock = threading.Lock()
+        self.connection().executescript(_SCHEMA)
+
+    def connection(self):
+        # connections are per thread and must not survive a fork
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def collection(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = SQLiteCollection(self, name)
+            return self._collections[name]
+
+    def capped_collection(self, name, size):
+        self._capped[name] = max(1, size // 128)
+        return self.collection(name)
+
+    def collection_names(self):
+        return [row[0] for row in self.connection().execute("SELECT DISTINCT collection FROM documents")]
+
+    def find_and_modify(self, collection, query, sort=None, update=None, remove=False, **write_concern):
+        return collection.find_and_modify(query, sort, update, remove)
+
+
+class SQLiteCollection(object):
+    def __init__(self, backend, name):
+        self.name = name
+        self._backend = backend
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+
+        with self._transaction() as conn:
+            self._insert(conn, docs)
+
+        ids = [doc['_id'] for doc in docs]
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        # the upsert is inserted in the same transaction as the failed match,
+        # so two processes can't both insert it
+        with self._transaction() as conn:
+            updated = 0
+
+            for seq, doc in list(self._matching(conn, spec, limit=0 if multi else 1)):
+                self._modify(conn, seq, doc, document)
+                updated += 1
+
+            if not updated and upsert:
+                self._insert(conn, [query.upsert_document(spec, document)])
+
+    def remove(self, spec_or_id=None, **kwargs):
+        with self._transaction() as conn:
+            for seq, doc in list(self._matching(conn, query.id_spec(spec_or_id))):
+                conn.execute("DELETE FROM documents WHERE seq = ?", (seq,))
+
+    def find(self, spec=None, fields=None, sort=None, limit=0, tailable=False, **kwargs):
+        if tailable:
+            return SQLiteTailableCursor(self, spec)
+
+        conn = self._backend.connection()
+        docs = [doc for (seq, doc) in self._matching(conn, spec, sort, limit)]
+        docs = query.sort_documents(docs, sort)
+
+        if limit:
+            docs = docs[:limit]
+
+        return query.Cursor([query.project(doc, fields) for doc in docs])
+
+    def find_one(self, spec_or_id=None, **kwargs):
+        for doc in self.find(query.id_spec(spec_or_id), limit=1, **kwargs):
+            return doc
+
+    def count(self):
+        return self._backend.connection().execute("SELECT COUNT(*) FROM documents WHERE collection = ?", (self.name,)).fetchone()[0]
+
+    def ensure_index(self, key_or_list, unique=False, sparse=False, expireAfterSeconds=None, **kwargs):
+        if expireAfterSeconds is not None:
+            self._backend._ttl[self.name] = query.Expiry(query.index_keys(key_or_list)[0], expireAfterSeconds)
+
+        if unique:
+            indexes = self._backend._unique.setdefault(self.name, [])
+            keys = query.index_keys(key_or_list)
+
+            if (keys, sparse) not in indexes:
+                indexes.append((keys, sparse))
+
+    def find_and_modify(self, spec, sort=None, update=None, remove=False):
+        with self._transaction() as conn:
+            rows = list(self._matching(conn, spec, sort, 1))
+
+            if not rows:
+                return None
+
+            seqs = dict((id(doc), seq) for (seq, doc) in rows)
+            doc = query.sort_documents([doc for (seq, doc) in rows], sort)[0]
+
+            if remove:
+                conn.execute("DELETE FROM documents WHERE seq = ?", (seqs[id(doc)],))
+            else:
+                self._modify(conn, seqs[id(doc)], copy.deepcopy(doc), update)
+
+            return doc
+
+    def _insert(self, conn, docs):
+        self._expire(conn)
+
+        for doc in docs:
+            doc.setdefault('_id', ObjectId())
+            self._check_unique(conn, doc)
+            conn.execute(
+                "INSERT INTO documents (collection, id, {0}, doc) VALUES (?, ?, {1}, ?)".format(
+                    ', '.join(_COLUMNS), ', '.join('?' for c in _COLUMNS)),
+                [self.name, unicode(doc['_id'])] + self._columns(doc) + [self._dump(doc)]
+            )
+
+        capped = self._backend._capped.get(self.name)
+        if capped:
+            conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND seq <= (SELECT MAX(seq) FROM documents WHERE collection = ?) - ?",
+                (self.name, self.name, capped)
+            )
+
+    def _modify(self, conn, seq, doc, update):
+        query.apply_update(doc, update)
+        self._check_unique(conn, doc)
+        conn.execute(
+            "UPDATE documents SET {0}, doc = ? WHERE seq = ?".format(', '.join('{0} = ?'.format(c) for c in _COLUMNS)),
+            self._columns(doc) + [self._dump(doc), seq]
+        )
+
+    def _matching(self, conn, spec, sort=None, limit=0):
+        spec = spec or dict()
+        where, params = self._pushdown(spec)
+        order = "seq"
+
+        # when sqlite can produce rows in the requested order, stop as soon as
+        # enough of them have matched instead of loading every candidate.
+        sort = query.normalize_sort(sort)
+        ordered = not sort or (len(sort) == 1 and sort[0][0] in _COLUMNS and sort[0][0] != 'queue')
+
+        if sort and ordered:
+            order = "{0} {1}, seq".format(sort[0][0], "ASC" if sort[0][1] > 0 else "DESC")
+
+        cursor = conn.execute(
+            "SELECT seq, doc FROM documents WHERE {0} ORDER BY {1}".format(' AND '.join(where), order),
+            params
+        )
+        found = 0
+
+        for seq, data in cursor:
+            doc = self._load(data)
+
+            if query.matches(doc, spec):
+                yield seq, doc
+                found += 1
+
+                if ordered and limit and found >= limit:
+                    break
+
+    def _pushdown(self, spec):
+        where = ["collection = ?"]
+        params = [self.name]
+
+        for key, cond in spec.iteritems():
+            column = 'id' if key == '_id' else key
+
+            if column != 'id' and column not in _COLUMNS:
+                continue
+
+            if not query.is_operator_dict(cond):
+                if cond is not None and not isinstance(cond, (dict, list)):
+                    where.append("{0} = ?".format(column))
+                    params.append(_column_value(cond))
+                continue
+
+            for op, arg in cond.iteritems():
+                if op == '$in' and arg and not any(isinstance(a, (dict, list)) or a is None for a in arg):
+                    where.append("{0} IN ({1})".format(column, ', '.join('?' for a in arg)))
+                    params.extend(_column_value(a) for a in arg)
+                elif op in ('$lt', '$lte', '$gt', '$gte') and column == 'scheduled_time' and isinstance(arg, datetime.datetime):
+                    # times are stored as floats, so only ever narrow to an
+                    # inclusive range and leave the exact test to python.
+                    where.append("{0} {1} ?".format(column, '<=' if op in ('$lt', '$lte') else '>='))
+                    params.append(_column_value(arg))
+
+        return where, params
+
+    def _expire(self, conn):
+        ttl = self._backend._ttl.get(self.name)
+        expired = ttl and ttl.due()
+
+        if expired:
+            for seq, doc in list(self._matching(conn, expired)):
+                conn.execute("DELETE FROM documents WHERE seq = ?", (seq,))
+
+    def _check_unique(self, conn, doc):
+        for keys, sparse in self._backend._unique.get(self.name, ()):
+            values = [query.get_path(doc, k) for k in keys]
+
+            if sparse and all(v is query._missing for v in values):
+                continue
+
+            spec = dict((k, None if v is query._missing else v) for (k, v) in zip(keys, values))
+            spec['_id'] = {'$ne' : doc['_id']}
+
+            for match in self._matching(conn, spec, limit=1):
+                raise pymongo.errors.DuplicateKeyError("E11000 duplicate key error on {0} {1}".format(self.name, keys))
+
+    def _columns(self, doc):
+        return [_column_value(query.get_path(doc, c)) for c in _COLUMNS]
+
+    def _dump(self, doc):
+        return sqlite3.Binary(cPickle.dumps(doc, 2))
+
+    def _load(self, data):
+        return cPickle.loads(str(data))
+
+    def _transaction(self):
+        return _Transaction(self._backend.connection())
+
+
+class _Transaction(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def __exit__(self, type, value, traceback):
+        self._conn.execute("COMMIT" if type is None else "ROLLBACK")
+
+
+class SQLiteTailableCursor(query.TailableCursor):
+    def _after(self, position):
+        conn = self._collection._backend.connection()
+        rows = conn.execute(
+            "SELECT seq, doc FROM documents WHERE collection = ? AND seq > ? ORDER BY seq",
+            (self._collection.name, position)
+        ).fetchall()
+
+        return [(seq, self._collection._load(data)) for (seq, data) in rows]
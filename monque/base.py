@@ -6,12 +6,22 @@ base.py
 Created by Kurtiss Hare on 2010-03-12.
 """
 
+import async_worker
+import backends
 import base64
 import datetime
+import itertools
 import job
+import limits
+import logging
+import notify
+import os
 import pymongo
 import pymongo.errors
 import pymongo.son
+import random
+import result
+import serialization
 import util
 import uuid
 import worker
@@ -19,10 +29,32 @@ from pymongo.objectid import ObjectId
 
 
 class Monque(object):
-    def __init__(self, mongodb, collection_prefix = "monque", default_queue = 'default_queue', max_retries = 5):
+    def __init__(self, mongodb, collection_prefix = "monque", default_queue = 'default_queue', max_retries = 5, chunk_size = 1000,
+                 notify = False, signal_size = 1024 * 1024, shared = False, priorities = None,
+                 serializer = None, compression = None, compress_threshold = 1024, claim_slots = None,
+                 results = False, result_ttl = 24 * 60 * 60, write_concerns = None, read_preferences = None,
+                 offload_threshold = None):
         self.mongodb = mongodb
+        self.backend = backends.get_backend(mongodb)
+        self.results = results
+        self.limits = limits.MonqueLimits(self)
         self._collection_prefix = collection_prefix
+        self._chunk_size = chunk_size
+        self._notify = notify
+        self._signal_size = signal_size
+        self._signal_collection = None
+        self._result_ttl = result_ttl
+        self._result_collection = None
+        self._write_concerns = write_concerns or dict()
+        self._read_preferences = read_preferences or dict()
+        self._shared = shared
+        self._priorities = priorities or dict()
+        self._codec = serialization.MonqueBodyCodec(serializer, compression, compress_threshold)
+        self._offload_threshold = offload_threshold
+        self._claim_slots = claim_slots
+        self._slot_cycle = itertools.count(random.randrange(claim_slots or 1))
         self._initialized_queues = dict()
+        self._count_buffer = None
         self._workorder_defaults = dict(
             queue       = default_queue,
             retries     = max_retries,
@@ -35,77 +67,353 @@ class Monque(object):
             queues = (self._workorder_defaults['queue'],)
         
         for queue in queues:
-            self.get_queue_collection(queue).remove()
+            c = self.get_queue_collection(queue)
+
+            if self._offload_threshold is not None:
+                self._delete_payloads(c.find(dict(self._queue_query([queue]), **{'body.blob' : {'$exists' : True}})))
+
+            c.remove(self._queue_query([queue]), **self.write_concern('jobs'))
+
+        self.reconcile_queue_sizes(queues)
     
     # low-level
     
-    def push(self, queue, item, delay=0, retries=5):
+    def push(self, queue, item, delay=0, retries=5, priority=None, unique_key=None, on_duplicate="keep", batch=None, func=None):
         now = datetime.datetime.utcnow()
         c = self.get_queue_collection(queue)
-        _id = c.insert(dict(
-            inserted_time   = now,
-            scheduled_time  = now + (delay if isinstance(delay, datetime.timedelta) else datetime.timedelta(seconds=delay)),
-            random_token    = self._random_token(),
-            retries         = retries,
-            failures        = [],
-            body            = item,
-        ))
+        row = self._new_row(now, queue, item, delay, retries, priority, unique_key, batch, func)
+
+        if unique_key is None:
+            try:
+                _id = c.insert(row, **self.write_concern('jobs'))
+            except Exception:
+                self._delete_payloads([row])
+                raise
+
+            self._count(queue, size = 1)
+        else:
+            _id = self._push_unique(queue, c, row, on_duplicate)
+
+        self.notify(queue, delay)
         return str(_id)
+
+    def _push_unique(self, queue, c, row, on_duplicate):
+        # the sparse unique index on unique_key collapses a duplicate of a
+        # pending job on insert.  "keep" leaves the pending job alone and
+        # returns its id, "replace" swaps it for the new one.  claiming a job
+        # drops its key, so a running job never blocks a new one.
+        while True:
+            if on_duplicate == "replace":
+                replaced = self.backend.find_and_modify(c, dict(unique_key = row['unique_key']), remove=True, **self.write_concern('jobs'))
+
+                if replaced:
+                    self._delete_payloads([replaced])
+                    self._count(queue, size = -1)
+
+            try:
+                _id = c.insert(row, **dict(self.write_concern('jobs'), safe = True))
+                self._count(queue, size = 1)
+                return _id
+            except pymongo.errors.DuplicateKeyError:
+                if on_duplicate != "replace":
+                    existing = c.find_one(dict(unique_key = row['unique_key']), fields = ['_id'])
+                    if existing:
+                        # this copy is never stored, and neither is its payload
+                        self._delete_payloads([row])
+                        return existing['_id']
+            except Exception:
+                self._delete_payloads([row])
+                raise
+
+    def push_many(self, queue, items, delay=0, retries=5, chunk_size=None, priority=None, batch=None, func=None):
+        chunk_size = chunk_size or self._chunk_size
+        now = datetime.datetime.utcnow()
+        c = self.get_queue_collection(queue)
+        rows = [self._new_row(now, queue, item, delay, retries, priority, batch=batch, func=func) for item in items]
+        ids = []
+
+        try:
+            for i in xrange(0, len(rows), chunk_size):
+                ids.extend(str(_id) for _id in c.insert(rows[i:i + chunk_size], **self.write_concern('jobs')))
+        except Exception:
+            # a chunk may have gone in part way; the payloads of the rows
+            # that didn't would be left behind
+            pending = [row for row in rows[len(ids):] if '_id' in row]
+            stored = set(row['_id'] for row in c.find({'_id' : {'$in' : [row['_id'] for row in pending]}}, fields=['_id']))
+            self._delete_payloads([row for row in rows[len(ids):] if row.get('_id') not in stored])
+
+            if ids or stored:
+                self._count(queue, size = len(ids) + len(stored))
+            raise
+
+        if ids:
+            self._count(queue, size = len(ids))
+            self.notify(queue, delay)
+
+        return ids
     
-    def pop(self, queue, grabfor=None, ordered=True):
+    def pop(self, queue, grabfor=None, ordered=True, owner=None):
+        return self._pop([queue], grabfor, ordered, owner)
+
+    def pop_any(self, queues, grabfor=None, ordered=True, owner=None):
+        # picks the best ready job across several queues in one round-trip;
+        # only available when queues share a collection.
+        if not self._shared:
+            raise ValueError("pop_any requires a Monque created with shared=True.")
+
+        return self._pop(queues, grabfor, ordered, owner)
+
+    def _pop(self, queues, grabfor, ordered, owner=None, spec=None):
+        if self.limits.configured():
+            return self._pop_limited(queues, grabfor, ordered, owner, spec)
+
+        return self._claim(queues, grabfor, ordered, owner, spec)
+
+    def _pop_limited(self, queues, grabfor, ordered, owner=None, spec=None, attempts=3):
+        # queues and job functions already at a limit are left out of the
+        # claim, so a worker moves straight on to its other queues.  the
+        # claimed job then takes its tokens and slots for real, and goes back
+        # if another worker got to them first.
+        for attempt in xrange(attempts):
+            funcs = [key for key in self.limits.configured() if key.startswith('func:')]
+            blocked = self.limits.blocked(['queue:' + q for q in queues] + funcs)
+            open_queues = [q for q in queues if 'queue:' + q not in blocked]
+
+            if not open_queues:
+                return None
+
+            query = dict(spec or ())
+            blocked_funcs = [key[len('func:'):] for key in funcs if key in blocked]
+
+            if blocked_funcs:
+                query['func'] = {'$nin' : blocked_funcs}
+
+            row = self._claim(open_queues, grabfor, ordered, owner, query)
+
+            if not row:
+                return None
+
+            queue = row.get('queue', open_queues[0])
+            keys = ['queue:' + queue]
+
+            if row.get('func'):
+                keys.append('func:' + row['func'])
+
+            held = self.limits.acquire(keys)
+
+            if held is not None:
+                # a job claimed without a lease is gone once claimed, so it
+                # spends a token but holds no slot
+                if not grabfor:
+                    self.limits.release(held)
+                return row
+
+            self._unclaim(queue, row, grabfor)
+
+    def _unclaim(self, queue, row, grabfor):
+        # puts back a job claimed past a limit.  its unique_key stays
+        # dropped, as a duplicate may have been pushed since.
         c = self.get_queue_collection(queue)
+        _id = ObjectId(row['_id'])
+
+        leased = 'lease_owner' in row
+
+        if grabfor and leased:
+            c.update(dict(_id = _id), {
+                '$set' : {"scheduled_time": row['scheduled_time'], "lease_owner": row['lease_owner']},
+            }, **self.write_concern('claims'))
+        elif grabfor:
+            c.update(dict(_id = _id), {
+                '$set' : {"scheduled_time": row['scheduled_time']},
+                '$unset' : {"lease_owner": 1},
+            }, **self.write_concern('claims'))
+            self._count(queue, in_flight = -1)
+        else:
+            row = dict(row, _id = _id)
+            row.pop('unique_key', None)
+            c.insert(row, **self.write_concern('claims'))
+            self._count(queue, size = 1, in_flight = 1 if leased else 0)
+
+    def _claim(self, queues, grabfor, ordered, owner=None, spec=None):
+        c = self.get_queue_collection(queues[0])
         now = datetime.datetime.utcnow()
         
         result = None
 
         if grabfor:
-            extra = [('update', {'$set': {"scheduled_time": now + datetime.timedelta(seconds=grabfor)}})]
+            # a claim without an owner still marks the job leased, so that
+            # it is counted in flight rather than delayed
+            claim = {"scheduled_time": now + datetime.timedelta(seconds=grabfor), "lease_owner": owner}
+            modify = dict(update = {'$set': claim, '$unset': {'unique_key': 1}})
         else:
-            extra = [('remove', True)]
+            modify = dict(remove = True)
+
+        modify.update(self.write_concern('claims'))
             
-        query = dict(
-            scheduled_time = {'$lte' : now},
-            retries = {'$gt' : 0}
-        )
+        query = self._ready_query(queues, now)
+        query.update(spec or dict())
 
-        if not ordered:
+        if not ordered and self._claim_slots:
+            # each claimant claims from a window of three slots, starting at
+            # its own and moving one window on with every claim, so a large
+            # fleet spreads across claim_slots disjoint index ranges and a
+            # claimant covers every slot within claim_slots / 3 claims.  an
+            # empty window falls back only to rows pushed before slots were
+            # enabled, so that a sparse queue doesn't send every claimant
+            # back to the same index head.
+            width = min(3, self._claim_slots)
+            start = self._slot_cycle.next() * width
+            window = [(start + i) % self._claim_slots for i in xrange(width)]
+
+            for q in (dict(query, slot = {'$in' : window}), dict(query, slot = {'$exists' : False})):
+                result = self.backend.find_and_modify(c, q, self._claim_sort(), **modify)
+                if result:
+                    break
+        elif not ordered:
             capture_token = self._random_token()
             directions = (('$gte', pymongo.ASCENDING), ('$lt', pymongo.DESCENDING))
 
             for operator, order in directions:
                 query['random_token'] = { operator : capture_token }
-                try:
-                    result = self.mongodb.command(pymongo.son.SON([
-                        ('findandmodify', c.name),
-                        ('query', query),
-                        ('sort', dict(random_token = order)),
-                    ] + extra))
-                except pymongo.errors.OperationFailure:
-                    pass # No matching object found
-                else:
+                result = self.backend.find_and_modify(c, query, dict(random_token = order), **modify)
+                if result:
                     break
         else:
-            try:
-                result = self.mongodb.command(pymongo.son.SON([
-                    ('findandmodify', c.name),
-                    ('query', query),
-                    ('sort', dict(scheduled_time = pymongo.ASCENDING)),
-                ] + extra))
-            except pymongo.errors.OperationFailure:
-                pass # No matching object found
+            result = self.backend.find_and_modify(c, query, self._claim_sort(), **modify)
 
         if not result:
             return None
 
-        result = result['value']
+        # the row as it was before the claim; one whose lease had run out
+        # was already counted in flight
+        leased = 'lease_owner' in result
+
+        if grabfor and not leased:
+            self._count(result.get('queue', queues[0]), in_flight = 1)
+        elif not grabfor:
+            self._count(result.get('queue', queues[0]), size = -1, in_flight = -1 if leased else 0)
+
         result['_id'] = str(result['_id'])
         return result
 
+    def pop_many(self, queue, n, grabfor=None, owner=None, ordered=True):
+        return self._pop_many([queue], n, grabfor, owner, ordered=ordered)
+
+    def _pop_many(self, queues, n, grabfor, owner=None, spec=None, ordered=True):
+        # claims up to n jobs by stamping them with a lease token, then reads
+        # back whatever this lease actually won in a single query, and tries
+        # again with fresh candidates when a racing claimant won them all.
+        # under limits every job has to be taken on its own, the way pop would.
+        if n <= 0:
+            # a find limited to 0 would be no limit at all
+            return []
+
+        if self.limits.configured():
+            rows = []
+
+            while len(rows) < n:
+                row = self._pop(queues, grabfor, ordered, owner, spec)
+
+                if not row:
+                    break
+
+                rows.append(row)
+
+            return rows
+
+        c = self.get_queue_collection(queues[0])
+        rows = None
+
+        while not rows:
+            now = datetime.datetime.utcnow()
+            query = self._ready_query(queues, now)
+            query.update(spec or dict())
+            found = self._claim_candidates(c, query, n, ordered)
+            candidates = [row['_id'] for row in found]
+            leased = set(row['_id'] for row in found if 'lease_owner' in row)
+
+            if not candidates:
+                return []
+
+            lease = self._random_token()
+            claim = dict(
+                scheduled_time = now + datetime.timedelta(seconds=grabfor or 60),
+                lease = lease,
+                lease_owner = owner,
+            )
+
+            query['_id'] = {'$in' : candidates}
+            c.update(query, {'$set' : claim, '$unset' : {'unique_key' : 1}}, multi=True, **self.write_concern('claims'))
+
+            rows = dict((row['_id'], row) for row in c.find(dict(_id = {'$in' : candidates}, lease = lease)))
+
+        if not grabfor:
+            c.remove(dict(_id = {'$in' : candidates}, lease = lease), **self.write_concern('claims'))
+
+        results = []
+        claimed = dict()
+
+        for _id in candidates:
+            row = rows.get(_id)
+            if row:
+                row['_id'] = str(row['_id'])
+                results.append(row)
+                counts = claimed.setdefault(row.get('queue', queues[0]), dict(size = 0, in_flight = 0))
+
+                if grabfor and _id not in leased:
+                    counts['in_flight'] += 1
+                elif not grabfor:
+                    counts['size'] -= 1
+                    counts['in_flight'] -= 1 if _id in leased else 0
+
+        for queue, counts in claimed.iteritems():
+            self._count(queue, **counts)
+
+        return results
+
+    def _claim_candidates(self, c, query, n, ordered):
+        # up to n ready rows to claim.  unordered claimants start from a
+        # random token, so that racing claimants mostly go after different rows
+        fields = ['_id', 'lease_owner']
+
+        if ordered:
+            return list(c.find(query, fields=fields, sort=self._claim_sort().items(), limit=n))
+
+        token = self._random_token()
+        found = list(c.find(dict(query, random_token = {'$gte' : token}), fields=fields, sort=[('random_token', pymongo.ASCENDING)], limit=n))
+
+        if len(found) < n:
+            found.extend(c.find(dict(query, random_token = {'$lt' : token}), fields=fields, sort=[('random_token', pymongo.DESCENDING)], limit=n - len(found)))
+
+        return found
+
+    def _ready_query(self, queues, now):
+        query = dict(
+            scheduled_time = {'$lte' : now},
+            retries = {'$gt' : 0}
+        )
+        query.update(self._queue_query(queues))
+        return query
+
+    def _queue_query(self, queues):
+        if not self._shared:
+            return dict()
+        elif len(queues) == 1:
+            return dict(queue = queues[0])
+        else:
+            return dict(queue = {'$in' : list(queues)})
+
+    def _claim_sort(self):
+        if self._shared:
+            return pymongo.son.SON([('priority', pymongo.DESCENDING), ('scheduled_time', pymongo.ASCENDING)])
+        return pymongo.son.SON([('scheduled_time', pymongo.ASCENDING)])
+
     def update(self, queue, job_id, delay=None, failure=None):
         spec = {}
         if delay is not None:
             now = datetime.datetime.utcnow()
             spec['$set'] = {"scheduled_time": now + datetime.timedelta(seconds=delay)}
+            spec['$unset'] = {"lease_owner": 1}
         if failure:
             spec.update({
                 "$push": {"failures": failure},
@@ -115,54 +423,536 @@ class Monque(object):
         if not spec:
             return
 
+        # the row comes back as it was, to tell whether this released a lease
         c = self.get_queue_collection(queue)
-        c.update({"_id": ObjectId(job_id)}, spec)
+        row = self.backend.find_and_modify(c, {"_id": ObjectId(job_id)}, update=spec, **self.write_concern('jobs'))
+
+        if row and delay is not None and 'lease_owner' in row:
+            self._count(queue, in_flight = -1)
+            self._release_limits(queue, row)
 
     def remove(self, queue, job_id):
         c = self.get_queue_collection(queue)
-        c.remove({"_id": ObjectId(job_id)})
+        row = self.backend.find_and_modify(c, {"_id": ObjectId(job_id)}, remove=True, **self.write_concern('jobs'))
+
+        if row:
+            self._delete_payloads([row])
+            self._count(queue, size = -1, in_flight = -1 if 'lease_owner' in row else 0)
+            self._release_limits(queue, row)
+
+    def bury(self, queue, job_id, failure=None):
+        # moves a job that has run out of retries from its queue into
+        # dead:<queue>, so the queue collection and its indexes only ever
+        # hold work that can still run.
+        # the dead copy is written before the job leaves its queue, so that
+        # a failure in between never loses it
+        c = self.get_queue_collection(queue)
+        row = c.find_one({"_id": ObjectId(job_id)})
+
+        if not row:
+            return
+
+        self._bury_row(queue, dict(row), failure)
+        row = self.backend.find_and_modify(c, {"_id": ObjectId(job_id)}, remove=True, **self.write_concern('jobs'))
+
+        if row:
+            self._release_limits(queue, row)
+            self._count(queue, size = -1, in_flight = -1 if 'lease_owner' in row else 0, dead = 1)
+        else:
+            # finished or buried elsewhere in the meantime
+            self.get_dead_collection(queue).remove(dict(_id = ObjectId(job_id)), **self.write_concern('jobs'))
+
+    def _bury_row(self, queue, row, failure=None):
+        for field in ('lease', 'lease_owner', 'unique_key', 'slot'):
+            row.pop(field, None)
+
+        row['retries'] = 0
+        row['died_time'] = datetime.datetime.utcnow()
+
+        if failure:
+            row['failures'] = row.get('failures', []) + [failure]
+
+        dc = self.get_dead_collection(queue)
+        dc.update(dict(_id = row['_id']), row, upsert=True, **self.write_concern('jobs'))
+
+    def requeue_dead(self, queue, job_ids=None, retries=None, chunk_size=None):
+        # puts dead jobs (all of them, or just job_ids) back on their queue
+        # with a fresh set of retries; their failure history is kept.
+        chunk_size = chunk_size or self._chunk_size
+        retries = retries or self._workorder_defaults['retries']
+        dc = self.get_dead_collection(queue)
+        c = self.get_queue_collection(queue)
+        requeued = []
+
+        while True:
+            rows = list(dc.find(self._dead_query(job_ids), limit=chunk_size))
+
+            if not rows:
+                break
+
+            now = datetime.datetime.utcnow()
+
+            for row in rows:
+                row.pop('died_time', None)
+                row.update(self._new_row(now, queue, row['body'], 0, retries, row.get('priority')), failures = row['failures'])
+
+            c.insert(rows, **self.write_concern('jobs'))
+            ids = [row['_id'] for row in rows]
+            dc.remove({'_id' : {'$in' : ids}}, **self.write_concern('jobs'))
+            self._count(queue, size = len(ids), dead = -len(ids))
+            requeued.extend(ids)
+
+        if requeued:
+            self.notify(queue)
+
+        return [str(_id) for _id in requeued]
+
+    def purge_dead(self, queue, job_ids=None, before=None):
+        spec = self._dead_query(job_ids)
+
+        if before:
+            spec['died_time'] = {'$lt' : before}
+
+        dc = self.get_dead_collection(queue)
+
+        if self._offload_threshold is not None:
+            self._delete_payloads(dc.find(dict(spec, **{'body.blob' : {'$exists' : True}})))
+
+        dc.remove(spec, **self.write_concern('jobs'))
+        self.reconcile_queue_sizes([queue])
+
+    def _dead_query(self, job_ids=None):
+        if job_ids is None:
+            return dict()
+        return {'_id' : {'$in' : [ObjectId(_id) for _id in job_ids]}}
+
+    def renew(self, queues, owner, grabfor):
+        # pushes back the lease on every job `owner` still holds
+        now = datetime.datetime.utcnow()
+
+        for c in self._queue_collections(queues):
+            c.update(dict(lease_owner = owner), {
+                '$set' : {"scheduled_time": now + datetime.timedelta(seconds=grabfor)}
+            }, multi=True, **self.write_concern('claims'))
+
+    def reap(self, stale_after=60, action="release"):
+        # workers that have not heartbeat within stale_after seconds, or
+        # within their own lease when that is longer, are presumed dead.
+        # their jobs are made ready again straight away, and with
+        # action="fail" also charged a retry.
+        now = datetime.datetime.utcnow()
+        wc = self.get_collection('workers')
+        reaped = []
+
+        # always from the primary: a lagging secondary would make live
+        # workers look stale, and their jobs would run twice
+        for w in wc.find(dict(heartbeat = {'$lt' : now - datetime.timedelta(seconds=stale_after)})):
+            if w.get('lease') and w['heartbeat'] >= now - datetime.timedelta(seconds=w['lease']):
+                # still within the lease it renews its jobs for
+                continue
+
+            spec = {
+                '$set' : {"scheduled_time": now},
+                '$unset' : {"lease_owner": 1},
+            }
+
+            failure = "Worker {0} on {1} stopped heartbeating".format(w['_id'], w.get('hostname'))
+
+            if action == "fail":
+                spec['$inc'] = {"retries": -1}
+                spec['$push'] = {"failures": failure}
+
+            for queue in w.get('queues') or ():
+                c = self.get_queue_collection(queue)
+
+                if action == "fail":
+                    # jobs on their last attempt die rather than go back
+                    dying = dict(lease_owner = w['_id'], retries = {'$lte' : 1})
+                    dying.update(self._queue_query([queue]))
+
+                    for row in c.find(dying):
+                        self._bury_row(queue, row, failure)
+                        c.remove(dict(_id = row['_id']), **self.write_concern('claims'))
+
+                c.update(dict(lease_owner = w['_id']), spec, multi=True, **self.write_concern('claims'))
+
+            logging.warn("Reaped worker {0} on {1} (pid {2})".format(w['_id'], w.get('hostname'), w.get('pid')))
+            wc.remove(dict(_id = w['_id']), **self.write_concern('heartbeats'))
+            reaped.append(w['_id'])
+            # the multi-updates above don't say how many jobs they moved
+            self.reconcile_queue_sizes(w.get('queues') or ())
+
+        if reaped and self.limits.configured():
+            self.limits.reconcile()
+
+        return reaped
+
+    def set_limit(self, queue=None, func=None, rate=None, burst=None, max_concurrency=None):
+        # limits claims from a queue, or of a job function across every
+        # queue, to `rate` per second (in bursts of up to `burst`) and to
+        # max_concurrency jobs running at once.  shared by every worker.
+        self.limits.set(self._limit_key(queue, func), rate, burst, max_concurrency)
+
+    def remove_limit(self, queue=None, func=None):
+        self.limits.remove(self._limit_key(queue, func))
+
+    def _release_limits(self, queue, row):
+        # frees the slots a leased job held under the limits of its queue
+        # and job function, once it is done with or given back
+        if 'lease_owner' not in row or not self.limits.configured():
+            return
+
+        keys = ['queue:' + row.get('queue', queue)]
+
+        if row.get('func'):
+            keys.append('func:' + row['func'])
+
+        self.limits.release(keys)
+
+    def _limit_key(self, queue, func):
+        if (queue is None) == (func is None):
+            raise ValueError("A limit applies to either a queue or a job function.")
+
+        return 'queue:' + queue if func is None else 'func:' + func
+
+    def queue_sizes(self, queues=None):
+        # {queue: dict(ready, delayed, in_flight, failed)}, read from the
+        # counters in queue_stats plus a count of the delayed jobs over the
+        # scheduled_time index, which is as big as the backlog of future
+        # work rather than the queue.
+        now = datetime.datetime.utcnow()
+        spec = dict() if queues is None else dict(queue = {'$in' : list(queues)})
+        sizes = dict()
+
+        for row in self.read_collection('stats', 'queue_stats').find(spec):
+            queue = row['queue']
+            delayed = dict(
+                scheduled_time  = {'$gt' : now},
+                retries         = {'$gt' : 0},
+                lease_owner     = {'$exists' : False},
+            )
+            delayed.update(self._queue_query([queue]))
+            delayed = self.get_queue_collection(queue).find(delayed).count()
+            in_flight = max(row.get('in_flight', 0), 0)
+
+            sizes[queue] = dict(
+                ready       = max(row.get('size', 0) - in_flight - delayed, 0),
+                delayed     = delayed,
+                in_flight   = in_flight,
+                failed      = max(row.get('dead', 0), 0),
+            )
+
+        return sizes
+
+    def reconcile_queue_sizes(self, queues=None):
+        # recounts the queue_stats counters from the collections themselves,
+        # correcting whatever drift crashes or unacknowledged writes caused
+        if queues is None:
+            queues = [row['queue'] for row in self.get_collection('queue_stats').find(fields=['queue']) if 'queue' in row]
+
+        for queue in queues:
+            c = self.get_queue_collection(queue)
+            held = dict(lease_owner = {'$exists' : True})
+            held.update(self._queue_query([queue]))
+
+            self.get_collection('queue_stats').update(dict(queue = queue), {'$set' : dict(
+                size        = c.find(self._queue_query([queue])).count(),
+                in_flight   = c.find(held).count(),
+                dead        = self.get_dead_collection(queue).count(),
+            )}, upsert=True, **self.write_concern('stats'))
+
+    def buffer_counts(self, buffer):
+        # sends the queue size counters of this process through a worker's
+        # stats.MonqueStatsBuffer, so that claims and completions cost no
+        # writes of their own; None writes them straight through again.
+        # forked children of the worker still write theirs straight through.
+        self._count_buffer = buffer and (os.getpid(), buffer)
+
+    def _count(self, queue, **counters):
+        pid, buffer = self._count_buffer or (None, None)
+
+        if buffer is not None and pid == os.getpid():
+            buffer.incr('queue_stats', dict(queue = queue), upsert=True, **counters)
+        else:
+            self.get_collection('queue_stats').update(dict(queue = queue), {'$inc' : counters}, upsert=True, **self.write_concern('stats'))
+
+    def write_concern(self, kind):
+        # the getLastError options for one class of writes: 'jobs' (pushes,
+        # retries, removals, dead letters and results), 'claims' (claims,
+        # lease renewals, reaping and limits), 'stats' and 'heartbeats'.
+        # e.g. write_concerns = dict(jobs = dict(j = True), stats = dict(safe = False))
+        return dict(self._write_concerns.get(kind) or ())
+
+    def read_collection(self, kind, *args):
+        # the collection to read one class of data ('stats' or 'heartbeats')
+        # from for display; read_preferences = dict(stats = "secondary")
+        # sends those reads to the backend's secondary, where it has one.
+        # anything that decides what to do with jobs reads the primary.
+        if self._read_preferences.get(kind) == "secondary":
+            return self.backend.secondary_collection(':'.join([self._collection_prefix] + list(args)))
+        return self.get_collection(*args)
+
+    def notify(self, queue, delay=0):
+        # delayed jobs are left to the polling fallback; a wakeup now would
+        # only find them not yet ready.
+        if not self._notify or delay:
+            return
+
+        c = self.get_signal_collection()
+        c.insert(dict(queue = queue, time = datetime.datetime.utcnow()))
+
+    def listen(self, queues):
+        if self._notify:
+            return notify.MonqueListener(self, queues)
+
+    def store_result(self, queue, job_id, value=None, error=None):
+        if not self.results:
+            return
+
+        row = dict(
+            queue           = queue,
+            finished_time   = datetime.datetime.utcnow(),
+        )
+
+        if error is None:
+            row['body'] = self._codec.encode(dict(value = value))
+        else:
+            row['error'] = error
+
+        # an upsert, since a job that was reaped and run twice reports twice
+        c = self.get_result_collection()
+        c.update(dict(_id = ObjectId(job_id)), row, upsert=True, **self.write_concern('jobs'))
+        self.notify(self.result_channel(job_id))
+
+    def get_result(self, job_id):
+        c = self.get_result_collection()
+        row = c.find_one(dict(_id = ObjectId(job_id)))
+
+        if row is not None and 'body' in row:
+            row['value'] = self._codec.decode(row.pop('body'))['value']
+
+        return row
+
+    def result_channel(self, job_id):
+        return "result:{0}".format(job_id)
+
+    def _new_row(self, now, queue, item, delay, retries, priority=None, unique_key=None, batch=None, func=None):
+        if not isinstance(delay, datetime.timedelta):
+            delay = datetime.timedelta(seconds=delay)
+
+        row = dict(
+            inserted_time   = now,
+            scheduled_time  = now + delay,
+            random_token    = self._random_token(),
+            retries         = retries,
+            failures        = [],
+            body            = item,
+        )
+
+        if self._claim_slots:
+            row['slot'] = random.randrange(self._claim_slots)
+
+        if self._shared:
+            row['queue'] = queue
+            row['priority'] = self._priorities.get(queue, 0) if priority is None else priority
+
+        if unique_key is not None:
+            # queues sharing a collection must not collapse each other's jobs
+            row['unique_key'] = '{0}:{1}'.format(queue, unique_key) if self._shared else unique_key
+
+        if batch is not None:
+            row['batch'] = batch
+
+        if func is not None:
+            row['func'] = func
+
+        return row
 
     # high-level
 
     def enqueue(self, work_order, **kwargs):
         work_order.__configure__(kwargs)
         work_order.__configure__(self._workorder_defaults)
-        self.push(
+        job_id = self.push(
             queue = work_order.queue,
-            item = dict(
-                cls = util.get_toplevel_attrname(work_order.job.__class__),
-                message = work_order.job.__serialize__(),
-            ),
+            item = self._work_order_body(work_order),
             delay = work_order.delay,
-            retries = work_order.retries)
-        c = self.get_collection('queue_stats')
+            retries = work_order.retries,
+            unique_key = work_order.job.unique_key(),
+            on_duplicate = work_order.job.on_duplicate,
+            batch = work_order.job.batch_key(),
+            func = work_order.job.name)
+        return result.MonqueResult(self, work_order.queue, job_id)
+
+    def enqueue_many(self, work_orders, chunk_size=None, **kwargs):
+        # orders sharing a queue, delay, retry count and job function are pushed together;
+        # ids are returned in the order the work orders were given.
+        groups = dict()
+        ids = [None] * len(work_orders)
+
+        for i, work_order in enumerate(work_orders):
+            work_order.__configure__(kwargs)
+            work_order.__configure__(self._workorder_defaults)
 
-    def dequeue(self, queues=None, grabfor=None):
+            # a duplicate would abort a batch insert part way, so unique
+            # orders go through push one at a time
+            if work_order.job.unique:
+                ids[i] = self.push(
+                    queue = work_order.queue,
+                    item = self._work_order_body(work_order),
+                    delay = work_order.delay,
+                    retries = work_order.retries,
+                    unique_key = work_order.job.unique_key(),
+                    on_duplicate = work_order.job.on_duplicate,
+                    batch = work_order.job.batch_key(),
+                    func = work_order.job.name)
+                continue
+
+            key = (work_order.queue, work_order.delay, work_order.retries, work_order.job.batch_key(), work_order.job.name)
+            groups.setdefault(key, []).append((i, work_order))
+
+        for (queue, delay, retries, batch, func), group in groups.iteritems():
+            group_ids = self.push_many(
+                queue = queue,
+                items = [self._work_order_body(work_order) for (i, work_order) in group],
+                delay = delay,
+                retries = retries,
+                chunk_size = chunk_size,
+                batch = batch,
+                func = func)
+
+            for (i, work_order), _id in zip(group, group_ids):
+                ids[i] = _id
+
+        return ids
+
+    def _work_order_body(self, work_order):
+        body = self._offload(self._codec.encode(work_order.job.__serialize__(), work_order.job.serializer))
+        body['cls'] = util.get_toplevel_attrname(work_order.job.__class__)
+        return body
+
+    def _offload(self, body):
+        # a body of offload_threshold bytes or more is stored as a blob in
+        # payloads (GridFS on mongo), leaving only a reference in the queue
+        # document, so claims and the claim indexes stay small.  the blob
+        # is fetched once the job has been claimed.  dead jobs keep theirs
+        # until purged, so that they can still be requeued.
+        if self._offload_threshold is None:
+            return body
+
+        format, data = self._codec.to_bytes(body)
+
+        if len(data) < self._offload_threshold:
+            return body
+
+        return dict(format = format, blob = self.backend.put_blob(self._payloads_name(), data), size = len(data))
+
+    def _load_body(self, body):
+        if 'blob' not in body:
+            return body
+
+        data = self.backend.get_blob(self._payloads_name(), body['blob'])
+
+        if data is None:
+            raise ValueError("The payload {0} of this job is missing.".format(body['blob']))
+
+        return dict(format = body['format'], data = data)
+
+    def _delete_payloads(self, rows):
+        for row in rows:
+            body = row.get('body')
+
+            if isinstance(body, dict) and 'blob' in body:
+                self.backend.delete_blob(self._payloads_name(), body['blob'])
+
+    def _payloads_name(self):
+        return ':'.join([self._collection_prefix, 'payloads'])
+
+    def dequeue(self, queues=None, grabfor=None, weights=None, owner=None, ordered=True):
         if not queues:
             queues = (self._workorder_defaults['queue'],)
+
+        if self._shared:
+            return self._dequeue_shared(queues, grabfor, weights, owner, ordered)
         
         for queue in queues:
-            result = self._dequeue_from(queue, grabfor=grabfor)
+            result = self._dequeue_from(queue, grabfor=grabfor, owner=owner, ordered=ordered)
             
             if result:
                 return result
     
-    def _dequeue_from(self, queue, grabfor=None):
-        row = self.pop(queue, grabfor=grabfor)
+    def dequeue_many(self, queues=None, n=10, grabfor=None, owner=None, ordered=True):
+        if not queues:
+            queues = (self._workorder_defaults['queue'],)
+
+        if self._shared:
+            return [self._work_order_from_row(row['queue'], row, not grabfor) for row in self._pop_many(queues, n, grabfor, owner, ordered=ordered)]
+
+        results = []
+
+        for queue in queues:
+            rows = self.pop_many(queue, n - len(results), grabfor=grabfor, owner=owner, ordered=ordered)
+            results.extend(self._work_order_from_row(queue, row, not grabfor) for row in rows)
+
+            if len(results) >= n:
+                break
+
+        return results
+    
+    def dequeue_batch(self, queue, batch, n, grabfor=None, owner=None, ordered=True):
+        # claims up to n more pending calls of the batch_job `batch`
+        rows = self._pop_many([queue], n, grabfor, owner, spec=dict(batch = batch), ordered=ordered)
+        return [self._work_order_from_row(queue, row, not grabfor) for row in rows]
+
+    def _dequeue_shared(self, queues, grabfor, weights, owner, ordered=True):
+        # strict priority: the job with the highest priority across all of
+        # the queues wins.  with weights, a queue is drawn in proportion to its
+        # weight and tried first, falling back to strict priority when empty.
+        row = None
+
+        if weights:
+            total = sum(weights.get(q, 1) for q in queues)
+            draw = random.uniform(0, total)
+
+            for queue in queues:
+                draw -= weights.get(queue, 1)
+                if draw <= 0:
+                    break
+
+            row = self._pop([queue], grabfor, ordered, owner)
+
+        if not row:
+            row = self._pop(queues, grabfor, ordered, owner)
+
         if row:
-            JobCls = util.get_toplevel_attr(row['body']['cls'])
-            j = JobCls.__deserialize__(row['body']['message'])
-            
-            work_order = job.MonqueWorkOrder(j)
-            work_order.__configure__(dict(
-                job_id      = row['_id'],
-                queue       = queue,
-                retries     = row['retries'],
-                failures    = row['failures'],
-                delay       = datetime.timedelta(0)
-            ))
-            
-            return work_order
+            return self._work_order_from_row(row['queue'], row, not grabfor)
+
+    def _dequeue_from(self, queue, grabfor=None, owner=None, ordered=True):
+        row = self.pop(queue, grabfor=grabfor, ordered=ordered, owner=owner)
+        if row:
+            return self._work_order_from_row(queue, row, not grabfor)
+
+    def _work_order_from_row(self, queue, row, consumed=False):
+        # consumed rows were removed by their claim, so nothing will clean up
+        # after their payloads once the job is loaded
+        JobCls = util.get_toplevel_attr(row['body']['cls'])
+        j = JobCls.__deserialize__(self._codec.decode(self._load_body(row['body'])))
+
+        if consumed:
+            self._delete_payloads([row])
+        
+        work_order = job.MonqueWorkOrder(j)
+        work_order.__configure__(dict(
+            job_id      = row['_id'],
+            queue       = queue,
+            retries     = row['retries'],
+            failures    = row['failures'],
+            delay       = datetime.timedelta(0)
+        ))
+        work_order.inserted_time = row.get('inserted_time')
+        work_order.claimed_time = datetime.datetime.utcnow()
+        
+        return work_order
 
     #
     
@@ -171,12 +961,69 @@ class Monque(object):
             ('scheduled_time',  pymongo.ASCENDING),
             ('random_token',    pymongo.ASCENDING)
         ])
-    
+        coll.ensure_index('lease')
+        coll.ensure_index('lease_owner')
+        coll.ensure_index('unique_key', unique=True, sparse=True)
+        coll.ensure_index('batch', sparse=True)
+
+        if self._claim_slots:
+            coll.ensure_index([
+                ('slot',            pymongo.ASCENDING),
+                ('scheduled_time',  pymongo.ASCENDING)
+            ])
+
+        if self._shared:
+            coll.ensure_index([
+                ('queue',           pymongo.ASCENDING),
+                ('priority',        pymongo.DESCENDING),
+                ('scheduled_time',  pymongo.ASCENDING)
+            ])
+            coll.ensure_index([
+                ('priority',        pymongo.DESCENDING),
+                ('scheduled_time',  pymongo.ASCENDING)
+            ])
+
     def get_collection(self, *args):
-        return self.mongodb[':'.join([self._collection_prefix] + list(args))]
+        return self.backend.collection(':'.join([self._collection_prefix] + list(args)))
     
+    def get_signal_collection(self):
+        if self._signal_collection is None:
+            name = ':'.join([self._collection_prefix, 'signals'])
+            self._signal_collection = self.backend.capped_collection(name, self._signal_size)
+
+        return self._signal_collection
+
+    def get_result_collection(self):
+        if self._result_collection is None:
+            c = self.get_collection('results')
+            c.ensure_index('finished_time', expireAfterSeconds=self._result_ttl)
+            self._result_collection = c
+
+        return self._result_collection
+
+    def get_dead_collection(self, queue):
+        coll = self.get_collection('dead', queue)
+
+        if not self._initialized_queues.has_key(coll.name):
+            coll.ensure_index('died_time')
+            self._initialized_queues[coll.name] = True
+
+        return coll
+
+    def _queue_collections(self, queues):
+        collections = dict()
+
+        for queue in queues:
+            c = self.get_queue_collection(queue)
+            collections[c.name] = c
+
+        return collections.values()
+
     def get_queue_collection(self, queue):
-        coll = self.get_collection('queues', queue)
+        if self._shared:
+            coll = self.get_collection('jobs')
+        else:
+            coll = self.get_collection('queues', queue)
         
         if not self._initialized_queues.has_key(coll.name):
             self._initialize_queue(coll)
@@ -188,5 +1035,9 @@ class Monque(object):
         kwargs.setdefault('queues', [self._workorder_defaults['queue']])
         return worker.MonqueWorker(self, *args, **kwargs)
 
+    def new_async_worker(self, *args, **kwargs):
+        kwargs.setdefault('queues', [self._workorder_defaults['queue']])
+        return async_worker.AsyncMonqueWorker(self, *args, **kwargs)
+
     def _random_token(self):
-        return base64.b64encode(uuid.uuid4().bytes, ('-', '_')).rstrip('=')
+        return base64.b64encode(uuid.uuid4().bytes, '-_').rstrip('=')
@@ -8,15 +8,30 @@ Created by Kurtiss Hare on 2010-03-12.
 
 import datetime
 import functools
+import hashlib
+import json
 import pymongo
 import types
 import util
 
 
 class MonqueJob(object):
+    # None defers to the Monque's serializer; otherwise a format name such as
+    # "pickle" or a serialization.MonqueSerializer instance.
+    serializer = None
+
+    # True, or a function of the job's arguments returning what identifies
+    # it, enqueues at most one pending copy of each call.  on_duplicate picks
+    # which copy survives: the pending one ("keep") or the new one ("replace").
+    unique = None
+    on_duplicate = "keep"
+
     @classmethod
     def job_decorator(cls, **kwargs):
+        util.register(cls)
+
         def decorator(undecorated):
+            util.register(undecorated)
             return MonqueJobDecoration(cls, undecorated, kwargs)
         return decorator
         
@@ -37,8 +52,14 @@ class MonqueJob(object):
 
         super(MonqueJob, self).__init__()
 
+    @property
+    def name(self):
+        return util.get_toplevel_attrname(self._func)
+
     def __configure__(self, kwargs):
-        pass
+        for name in ('serializer', 'unique', 'on_duplicate'):
+            if kwargs.get(name) is not None and name not in self.__dict__:
+                setattr(self, name, kwargs[name])
 
     def __serialize__(self):
         return dict(
@@ -48,6 +69,23 @@ class MonqueJob(object):
             kwargs      = self._func_kwargs,
         )
 
+    def unique_key(self):
+        if not self.unique:
+            return None
+
+        message = self.__serialize__()
+
+        if callable(self.unique):
+            kwargs = dict((str(k), v) for (k,v) in self._func_kwargs.items())
+            call = [message['func'], self.unique(*self._func_args, **kwargs)]
+        else:
+            call = [message['func'], message['args'], message['kwargs']]
+
+        return hashlib.sha1(json.dumps(call, sort_keys=True, separators=(',', ':'), default=repr)).hexdigest()
+
+    def batch_key(self):
+        return None
+
     def run(self):
         kwargs = dict((str(k), v) for (k,v) in self._func_kwargs.items())
         return self._func(*self._func_args, **kwargs)
@@ -64,6 +102,87 @@ class MonqueJob(object):
         return not (self == other)
 
 
+class MonqueBatchJob(MonqueJob):
+    # one call of a batch_job function.  a worker that claims one claims up
+    # to max_size - 1 more pending calls of the same function, waiting up to
+    # max_wait seconds for them, and runs them all as a MonqueBatch.
+    max_size = 100
+    max_wait = 0
+
+    @classmethod
+    def __deserialize__(cls, message):
+        j = super(MonqueBatchJob, cls).__deserialize__(message)
+        j.max_size, j.max_wait = message['batch']
+        return j
+
+    def __init__(self, func, func_args, func_kwargs, id = None):
+        # a batch is handed a list of argument tuples, which has no room for
+        # keyword arguments
+        if func_kwargs:
+            raise TypeError("batch_job {0} takes positional arguments only.".format(util.get_toplevel_attrname(func)))
+
+        super(MonqueBatchJob, self).__init__(func, func_args, func_kwargs, id)
+
+    def __configure__(self, kwargs):
+        super(MonqueBatchJob, self).__configure__(kwargs)
+
+        for name in ('max_size', 'max_wait'):
+            if kwargs.get(name) is not None and name not in self.__dict__:
+                setattr(self, name, kwargs[name])
+
+    def __serialize__(self):
+        message = super(MonqueBatchJob, self).__serialize__()
+        message['batch'] = [self.max_size, self.max_wait]
+        return message
+
+    def batch_key(self):
+        return util.get_toplevel_attrname(self._func)
+
+    def run(self):
+        result = MonqueBatch([self]).run()[0]
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+
+class MonqueBatch(object):
+    # runs a batch_job function once over the arguments of several calls.
+    # the function may return a list with one entry per call, in which an
+    # exception instance fails just that call; if it raises, they all fail.
+
+    @classmethod
+    def __deserialize__(cls, message):
+        return cls([MonqueBatchJob.__deserialize__(m) for m in message['jobs']])
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def __configure__(self, kwargs):
+        pass
+
+    @property
+    def name(self):
+        return self.jobs[0].name
+
+    def __serialize__(self):
+        return dict(jobs = [j.__serialize__() for j in self.jobs])
+
+    def run(self):
+        results = self.jobs[0]._func([tuple(j._func_args) for j in self.jobs])
+
+        if results is None:
+            return [None] * len(self.jobs)
+
+        results = list(results)
+
+        if len(results) != len(self.jobs):
+            raise ValueError("Batch of {0} calls returned {1} results.".format(len(self.jobs), len(results)))
+
+        return results
+
+
 class MonqueJobDecoration(object):
     def __init__(self, job_cls, undecorated, configuration):
         self.job_cls = job_cls
@@ -77,6 +196,26 @@ class MonqueJobDecoration(object):
         return work_order
 
 
+class MonqueBatchOrder(object):
+    # the work orders of the calls in one MonqueBatch, processed as a unit
+    # but retried, failed and accounted for one by one.
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.job = MonqueBatch([order.job for order in orders])
+        self.queue = orders[0].queue
+
+    def split(self, error=None):
+        results = getattr(self, 'result', None) or [None] * len(self.orders)
+
+        for order, result in zip(self.orders, results):
+            if error is None and isinstance(result, Exception):
+                yield order, result
+            else:
+                order.result = result
+                yield order, error
+
+
 class MonqueWorkOrder(object):
     def __init__(self, job):
         self.job = job
@@ -111,6 +250,12 @@ class MonqueWorkOrder(object):
     def mark_completion(self):
         self.endTime = datetime.datetime.now()
         return self.endTime-self.startTime
+
+    def wait_time(self):
+        # seconds from enqueue to claim, for orders read from a queue row
+        if getattr(self, 'inserted_time', None) is None:
+            return None
+        return (self.claimed_time - self.inserted_time).total_seconds()
     
     def _set_delay(self, delay):
         if isinstance(delay, types.IntType):
@@ -132,4 +277,9 @@ class MonqueWorkOrder(object):
         return not (self == other)
 
 
-job = MonqueJob.job_decorator
\ No newline at end of file
+util.register(MonqueJob)
+util.register(MonqueBatchJob)
+util.register(MonqueBatch)
+
+job = MonqueJob.job_decorator
+batch_job = MonqueBatchJob.job_decorator
\ No newline at end of file
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+limits.py
+"""
+
+import time
+
+
+class MonqueLimits(object):
+    # rate limits and concurrency caps, kept in the limits collection with
+    # one document per queue ("queue:<name>") or job function
+    # ("func:<name>") and checked by every claim.  rates are token buckets,
+    # stored as the theoretical arrival time of the next token (GCRA), so
+    # taking a token is a single compare-and-swap.
+
+    def __init__(self, monque, refresh=5):
+        self._monque = monque
+        self._refresh = refresh
+        self._keys = None
+        self._loaded = 0
+
+    def collection(self):
+        return self._monque.get_collection('limits')
+
+    def set(self, key, rate=None, burst=None, max_concurrency=None):
+        # rate in claims per second, with up to `burst` of them at once
+        c = self.collection()
+        c.update(dict(_id = key), {'$set' : dict(
+            rate            = rate,
+            burst           = burst or 1,
+            max_concurrency = max_concurrency,
+        )}, upsert=True)
+        c.update(dict(_id = key, running = {'$exists' : False}), {'$set' : dict(running = 0)})
+        self._keys = None
+
+    def remove(self, key):
+        self.collection().remove(dict(_id = key))
+        self._keys = None
+
+    def configured(self):
+        # re-read every `refresh` seconds, so that claims pay nothing at all
+        # while no limits are set
+        if self._keys is None or time.time() - self._loaded >= self._refresh:
+            self._keys = set(doc['_id'] for doc in self.collection().find(fields=['_id']))
+            self._loaded = time.time()
+
+        return self._keys
+
+    def blocked(self, keys):
+        keys = [key for key in keys if key in self.configured()]
+
+        if not keys:
+            return set()
+
+        now = time.time()
+        return set(doc['_id'] for doc in self.collection().find({'_id' : {'$in' : keys}}) if not self._available(doc, now))
+
+    def acquire(self, keys):
+        # takes a token and a concurrency slot under every one of keys, or
+        # none at all.  returns the keys holding a slot, to be released once
+        # the job is done, or None when a limit has been reached.
+        taken = []
+
+        for key in keys:
+            if key not in self.configured():
+                continue
+
+            took = self._take(key)
+
+            if took is None:
+                self._refund(taken)
+                return None
+
+            taken.append(took)
+
+        return [key for (key, interval, slot) in taken if slot]
+
+    def release(self, keys):
+        # gives back a slot under each of keys that has a concurrency cap;
+        # a slot already recounted away by reconcile is not given back twice
+        c = self.collection()
+
+        for key in keys or ():
+            if key in self.configured():
+                spec = dict(_id = key, max_concurrency = {'$ne' : None}, running = {'$gt' : 0})
+                c.update(spec, {'$inc' : dict(running = -1)}, **self._monque.write_concern('claims'))
+
+    def reconcile(self):
+        # recounts the running jobs under each concurrency cap from the jobs
+        # workers actually hold, returning slots leaked by dead workers
+        c = self.collection()
+        queues = [row['queue'] for row in self._monque.get_collection('queue_stats').find(fields=['queue']) if 'queue' in row]
+
+        for doc in c.find(dict(max_concurrency = {'$ne' : None})):
+            kind, name = doc['_id'].split(':', 1)
+            if kind == 'queue':
+                running = self._held(name)
+            else:
+                running = sum(self._held(queue, func = name) for queue in queues)
+
+            c.update(dict(_id = doc['_id']), {'$set' : dict(running = running)})
+
+    def _held(self, queue, **spec):
+        # every leased job, including those claimed without an owner
+        spec['lease_owner'] = {'$exists' : True}
+        spec.update(self._monque._queue_query([queue]))
+        return self._monque.get_queue_collection(queue).find(spec).count()
+
+    def _available(self, doc, now):
+        if doc.get('max_concurrency') is not None and doc.get('running', 0) >= doc['max_concurrency']:
+            return False
+
+        if doc.get('rate'):
+            interval = 1.0 / doc['rate']
+            return max(doc.get('tat') or 0, now) - now <= interval * ((doc.get('burst') or 1) - 1)
+
+        return True
+
+    def _take(self, key, attempts=5):
+        c = self.collection()
+
+        for attempt in xrange(attempts):
+            doc = c.find_one(dict(_id = key))
+
+            if doc is None:
+                return key, 0, False # removed in the meantime
+
+            now = time.time()
+
+            if not self._available(doc, now):
+                return None
+
+            spec = dict(_id = key)
+            update = dict()
+            interval = 0
+            slot = doc.get('max_concurrency') is not None
+
+            if doc.get('rate'):
+                interval = 1.0 / doc['rate']
+                spec['tat'] = doc.get('tat')
+                update['$set'] = dict(tat = max(doc.get('tat') or 0, now) + interval)
+
+            if slot:
+                spec['running'] = {'$lt' : doc['max_concurrency']}
+                update['$inc'] = dict(running = 1)
+
+            if not update or self._monque.backend.find_and_modify(c, spec, update=update, **self._monque.write_concern('claims')):
+                return key, interval, slot
+
+        return None
+
+    def _refund(self, taken):
+        c = self.collection()
+
+        for key, interval, slot in taken:
+            inc = dict()
+
+            if interval:
+                inc['tat'] = -interval
+            if slot:
+                inc['running'] = -1
+
+            if inc:
+                c.update(dict(_id = key), {'$inc' : inc}, **self._monque.write_concern('claims'))
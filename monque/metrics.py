@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+metrics.py
+"""
+
+import BaseHTTPServer
+import threading
+
+# upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+
+HELP = dict(
+    wait_seconds    = "Time from enqueue to claim.",
+    run_seconds     = "Time spent running a job, successful or not.",
+)
+
+
+def _bucket_key(bound):
+    # mongo field names may not contain dots
+    return 'inf' if bound == float('inf') else repr(float(bound)).replace('.', '_')
+
+def _bucket_bound(key):
+    return float(key.replace('_', '.'))
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else '{0:g}'.format(bound)
+
+
+class MonqueHistogram(object):
+    # bucket counts, a sum and a count; two histograms over the same buckets
+    # merge by adding them up, which is also how the flushed $inc counters of
+    # every worker combine in the metrics collection.
+
+    def __init__(self, buckets=None, total=0.0, count=0):
+        self.buckets = dict(buckets or ())
+        self.sum = total
+        self.count = count
+
+    @classmethod
+    def from_document(cls, doc):
+        buckets = dict((_bucket_bound(k), v) for (k, v) in doc.get('buckets', dict()).iteritems())
+        return cls(buckets, doc.get('sum', 0.0), doc.get('count', 0))
+
+    @staticmethod
+    def counters(value):
+        # the $inc counters that record one observation
+        for bound in BUCKETS:
+            if value <= bound:
+                break
+
+        return {'buckets.' + _bucket_key(bound) : 1, 'sum' : value, 'count' : 1}
+
+    def observe(self, value):
+        for name, inc in self.counters(value).iteritems():
+            if name.startswith('buckets.'):
+                bound = _bucket_bound(name[len('buckets.'):])
+                self.buckets[bound] = self.buckets.get(bound, 0) + inc
+
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for bound, n in other.buckets.iteritems():
+            self.buckets[bound] = self.buckets.get(bound, 0) + n
+
+        self.sum += other.sum
+        self.count += other.count
+        return self
+
+    def cumulative(self):
+        seen = 0
+
+        for bound in sorted(set(BUCKETS) | set(self.buckets)):
+            seen += self.buckets.get(bound, 0)
+            yield bound, seen
+
+    def quantile(self, q):
+        # estimated the way prometheus' histogram_quantile does, by linear
+        # interpolation inside the bucket the quantile falls in
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        lower, below = 0.0, 0
+
+        for bound, seen in self.cumulative():
+            if seen >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - below) / float(seen - below or 1)
+            lower, below = bound, seen
+
+
+def histograms(monque, metric=None, **labels):
+    # {(metric, labels): histogram}, merged over every document that matches
+    spec = dict(labels)
+
+    if metric:
+        spec['metric'] = metric
+
+    merged = dict()
+
+    for doc in monque.read_collection('stats', 'metrics').find(spec):
+        key = (doc['metric'], tuple(sorted((k, doc[k]) for k in doc if k not in ('_id', 'metric', 'buckets', 'sum', 'count'))))
+        merged.setdefault(key, MonqueHistogram()).merge(MonqueHistogram.from_document(doc))
+
+    return merged
+
+def render(monque, namespace="monque"):
+    # the prometheus text exposition format
+    lines = []
+    last = None
+
+    for (metric, labels), histogram in sorted(histograms(monque).iteritems()):
+        name = "{0}_job_{1}".format(namespace, metric)
+
+        if metric != last:
+            lines.append("# HELP {0} {1}".format(name, HELP.get(metric, metric)))
+            lines.append("# TYPE {0} histogram".format(name))
+            last = metric
+
+        label_text = ','.join('{0}="{1}"'.format(k, unicode(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in labels)
+
+        for bound, seen in histogram.cumulative():
+            lines.append('{0}_bucket{{{1}{2}le="{3}"}} {4}'.format(name, label_text, ',' if label_text else '', _format_bound(bound), seen))
+
+        lines.append('{0}_sum{{{1}}} {2!r}'.format(name, label_text, float(histogram.sum)))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, label_text, histogram.count))
+
+    return '\n'.join(lines) + '\n'
+
+def serve(monque, port=9317, host='', background=False):
+    # a minimal exporter: every GET answers with render(monque)
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render(monque).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+
+    if not background:
+        server.serve_forever()
+        return server
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
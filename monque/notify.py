@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+notify.py
+"""
+
+import pymongo
+import time
+
+
+class MonqueListener(object):
+    # tails the capped signals collection for pushes onto any of `queues`.
+    # the cursor matches every signal, starting from the newest one there was
+    # when it was opened, so that it stays alive however long the queues are
+    # idle; signals for other queues are skipped here.  tailable cursors
+    # return immediately when there is nothing new, so an idle listener
+    # re-checks its cursor, starting every `poll` seconds and backing off to
+    # every `max_poll` seconds for as long as nothing arrives; that is a cheap
+    # getmore rather than a claim against each queue.
+
+    def __init__(self, monque, queues, poll=0.05, max_poll=1.0):
+        self._monque = monque
+        self._queues = list(queues)
+        self._poll = poll
+        self._max_poll = max(poll, max_poll)
+        self._delay = poll
+        self._cursor = None
+        self._newest = None
+
+    def wait(self, timeout, interrupt=None, sleep=time.sleep):
+        deadline = time.time() + timeout
+
+        while True:
+            if self._drain():
+                self._delay = self._poll
+                return True
+
+            remaining = deadline - time.time()
+
+            if remaining <= 0 or (interrupt and interrupt.is_set()):
+                return False
+
+            sleep(min(self._delay, remaining))
+            self._delay = min(self._delay * 2, self._max_poll)
+
+    def _drain(self):
+        if self._cursor is None or not self._cursor.alive:
+            self._cursor = self._open()
+
+        signalled = False
+
+        for signal in self._cursor:
+            if self._newest is not None:
+                # sent before the cursor was opened
+                if signal['_id'] == self._newest:
+                    self._newest = None
+                continue
+
+            if signal.get('queue') in self._queues:
+                signalled = True
+
+        # the newest signal may have been capped away before it was read
+        self._newest = None
+        return signalled
+
+    def _open(self):
+        # a tailable cursor whose first batch is empty comes back dead, so
+        # this re-queries only while no signal has ever been sent
+        c = self._monque.get_signal_collection()
+
+        for newest in c.find(sort=[('$natural', pymongo.DESCENDING)], limit=1):
+            self._newest = newest['_id']
+
+        return c.find(tailable=True)
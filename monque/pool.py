@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+pool.py
+"""
+
+import errno
+import job
+import logging
+import multiprocessing
+import resource
+import select
+import util
+
+
+class MonqueWorkerPool(object):
+    # long-lived children fed over a pipe, so fork() is paid once per child
+    # rather than once per job.  a child retires after max_jobs jobs or once its
+    # peak RSS exceeds max_rss bytes, and is replaced when its result is collected.
+
+    def __init__(self, worker, size, max_jobs=None, max_rss=None):
+        self._worker = worker
+        self._size = size
+        self._max_jobs = max_jobs
+        self._max_rss = max_rss
+        self._children = []
+
+    def start(self):
+        while len(self._children) < self._size:
+            self._children.append(self._spawn())
+
+    def idle(self):
+        return len([c for c in self._children if c.order is None])
+
+    def busy(self):
+        return len([c for c in self._children if c.order is not None])
+
+    def submit(self, order):
+        for child in self._children:
+            if child.order is None:
+                child.order = order
+                child.conn.send((
+                    order.queue,
+                    util.get_toplevel_attrname(order.job.__class__),
+                    order.job.__serialize__(),
+                    getattr(order, 'profile', False),
+                ))
+                return child.process.pid
+
+        raise RuntimeError("No idle child in pool.")
+
+    def collect(self, timeout=None):
+        # returns (order, error) pairs, error being None for successful jobs
+        busy = dict((c.conn.fileno(), c) for c in self._children if c.order is not None)
+
+        if not busy:
+            return []
+
+        try:
+            readable, _, _ = select.select(busy.keys(), [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+        results = []
+
+        for fd in readable:
+            child = busy[fd]
+            order, child.order = child.order, None
+
+            try:
+                error, retire, order.result, order.profile_stats = child.conn.recv()
+            except (EOFError, IOError):
+                child.process.join()
+                error = "Job failed with exit code {0}".format(child.process.exitcode)
+                retire = True
+
+            if retire:
+                self._replace(child)
+
+            results.append((order, error))
+
+        return results
+
+    def kill_busy(self):
+        for child in self._children:
+            if child.order is not None and child.process.is_alive():
+                logging.info("Killing child {0}".format(child.process))
+                child.process.terminate()
+
+    def stop(self):
+        for child in self._children:
+            try:
+                child.conn.send(None)
+            except IOError:
+                pass
+
+        for child in self._children:
+            child.process.join()
+            child.conn.close()
+
+        self._children = []
+
+    def _replace(self, child):
+        child.process.join()
+        child.conn.close()
+        self._children[self._children.index(child)] = self._spawn()
+
+    def _spawn(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target = _child_main,
+            args = (self._worker, child_conn, self._max_jobs, self._max_rss)
+        )
+        process.start()
+        child_conn.close()
+        return _PoolChild(process, parent_conn)
+
+
+class _PoolChild(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.order = None
+
+
+def _child_main(worker, conn, max_jobs, max_rss):
+    import traceback
+
+    worker.reset_signal_handlers()
+    processed = 0
+
+    while True:
+        util.setprocname("monque: Pool child waiting")
+
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        if message is None:
+            break
+
+        queue, cls, body, profile = message
+        error = None
+        result = None
+        profile_stats = None
+
+        try:
+            JobCls = util.get_toplevel_attr(cls)
+            order = job.MonqueWorkOrder(JobCls.__deserialize__(body))
+            order.__configure__(dict(queue = queue))
+            order.profile = profile
+            worker.dispatch(order)
+
+            if worker._wants_result(order):
+                result = order.result
+                profile_stats = getattr(order, 'profile_stats', None)
+        except Exception, e:
+            logging.warn("Job failed in pool child: {0}\n{1}".format(str(e), traceback.format_exc()))
+            error = str(e) or e.__class__.__name__
+
+        processed += 1
+        retire = bool(
+            (max_jobs and processed >= max_jobs) or
+            (max_rss and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 > max_rss)
+        )
+        conn.send((error, retire, result, profile_stats))
+
+        if retire:
+            break
+
+    conn.close()
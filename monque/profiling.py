@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+profiling.py
+"""
+
+import cProfile
+import pstats
+
+
+def run_profiled(job, limit=30):
+    # runs the job under cProfile; returns its result along with the `limit`
+    # functions it spent the most cumulative time in, as
+    # (label, calls, tottime, cumtime) tuples.
+    profiler = cProfile.Profile()
+    result = profiler.runcall(job.run)
+    return result, hot_spots(profiler, limit)
+
+def hot_spots(profiler, limit=30):
+    spots = []
+
+    for (filename, line, func), (cc, nc, tt, ct, callers) in pstats.Stats(profiler).stats.iteritems():
+        spots.append(("{0}:{1}({2})".format(filename, line, func), nc, tt, ct))
+
+    spots.sort(key=lambda spot: spot[3], reverse=True)
+    return spots[:limit]
+
+def counters(spots):
+    # the $inc counters that add one profile to its job function's totals in
+    # the profiles collection
+    inc = dict(samples = 1)
+
+    for label, calls, tottime, cumtime in spots:
+        key = 'functions.' + label.replace('.', '_').replace('$', '_')
+        inc[key + '.calls'] = calls
+        inc[key + '.tottime'] = tottime
+        inc[key + '.cumtime'] = cumtime
+
+    return inc
+
+def top(monque, func, limit=20, sort='cumtime'):
+    # the aggregated hot spots of a job function, busiest first, as
+    # (label, calls, tottime, cumtime) with times averaged per sampled run
+    doc = monque.read_collection('stats', 'profiles').find_one(dict(func = func))
+
+    if not doc:
+        return []
+
+    samples = float(doc.get('samples') or 1)
+    spots = [
+        (label, f.get('calls', 0) / samples, f.get('tottime', 0) / samples, f.get('cumtime', 0) / samples)
+        for (label, f) in doc.get('functions', dict()).iteritems()
+    ]
+    spots.sort(key=lambda spot: spot[('calls', 'tottime', 'cumtime').index(sort) + 1], reverse=True)
+    return spots[:limit]
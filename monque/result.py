@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+result.py
+"""
+
+import time
+
+try:
+    import gevent
+    import gevent.event
+except ImportError:
+    gevent = None
+
+
+class MonqueJobFailed(Exception):
+    pass
+
+
+class MonqueResultTimeout(Exception):
+    pass
+
+
+class MonqueResult(object):
+    # returned by Monque.enqueue.  results are only recorded by a Monque
+    # created with results=True; a job's result is its return value, or its
+    # last error once it has run out of retries.
+
+    def __init__(self, monque, queue, job_id):
+        self._monque = monque
+        self.queue = queue
+        self.job_id = job_id
+
+    def ready(self):
+        return self._monque.get_result(self.job_id) is not None
+
+    def get(self, timeout=None):
+        # with notifications on, workers signal each result as they store
+        # it and this blocks on the signal; otherwise it polls with backoff.
+        return self._get(timeout, time.sleep)
+
+    def _get(self, timeout, sleep):
+        if not self._monque.results:
+            raise ValueError("Results are only recorded by a Monque created with results=True.")
+
+        listener = self._monque.listen([self._monque.result_channel(self.job_id)])
+        deadline = None if timeout is None else time.time() + timeout
+        backoff = 0.05
+
+        while True:
+            row = self._monque.get_result(self.job_id)
+
+            if row is not None:
+                if 'error' in row:
+                    raise MonqueJobFailed(row['error'])
+                return row['value']
+
+            remaining = 1.0 if deadline is None else min(1.0, deadline - time.time())
+
+            if remaining <= 0:
+                raise MonqueResultTimeout("No result for job {0} after {1} seconds.".format(self.job_id, timeout))
+
+            if listener:
+                listener.wait(remaining, sleep=sleep)
+            else:
+                sleep(min(backoff, remaining))
+                backoff = min(backoff * 2, 1.0)
+
+    def async_result(self, timeout=None):
+        # the gevent counterpart of get: a gevent.event.AsyncResult filled in
+        # by a greenlet, so that many results can be waited on at once.  the
+        # greenlet waits with gevent.sleep, but its queries only yield to the
+        # hub once gevent.monkey.patch_all() has been called, as with
+        # AsyncMonqueWorker.
+        if gevent is None:
+            raise ImportError("MonqueResult.async_result requires gevent.")
+
+        async_result = gevent.event.AsyncResult()
+
+        def target():
+            try:
+                async_result.set(self._get(timeout, gevent.sleep))
+            except Exception, e:
+                async_result.set_exception(e)
+
+        gevent.spawn(target)
+        return async_result
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+serialization.py
+"""
+
+import abc
+import cPickle
+import pymongo.binary
+import zlib
+
+try:
+    import bson
+except ImportError:
+    import pymongo.bson as bson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    try:
+        import lz4
+    except ImportError:
+        lz4 = None
+
+
+class MonqueSerializer(object):
+    """
+    Turns a job's message dict into bytes and back.  Subclasses name their
+    encoding in `format`, which is stored with each body so that workers can
+    decode it, and register themselves in _serializers under that name.
+    """
+    __metaclass__ = abc.ABCMeta
+    format = None
+
+    @abc.abstractmethod
+    def dumps(self, message):
+        pass
+
+    @abc.abstractmethod
+    def loads(self, data):
+        pass
+
+
+class BSONSerializer(MonqueSerializer):
+    # stores the message as a plain subdocument, as monque always has
+    format = "bson"
+
+    def dumps(self, message):
+        return bson.BSON.encode(message)
+
+    def loads(self, data):
+        return bson.BSON(data).decode()
+
+
+class PickleSerializer(MonqueSerializer):
+    # the protocol is pinned so producers and workers on different python
+    # versions agree on the encoding.
+    format = "pickle"
+
+    def __init__(self, protocol=2):
+        self._protocol = protocol
+
+    def dumps(self, message):
+        return cPickle.dumps(message, self._protocol)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class MsgpackSerializer(MonqueSerializer):
+    format = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MsgpackSerializer requires msgpack.")
+
+    def dumps(self, message):
+        message = dict(message, id = str(message['id']))
+        return msgpack.packb(message)
+
+    def loads(self, data):
+        return msgpack.unpackb(data)
+
+
+_serializers = dict(
+    bson    = BSONSerializer,
+    pickle  = PickleSerializer,
+    msgpack = MsgpackSerializer,
+)
+
+_compressors = dict(
+    zlib    = (zlib.compress, zlib.decompress),
+)
+
+if lz4 is not None:
+    _compressors['lz4'] = (lz4.compress, lz4.decompress)
+
+
+def get_serializer(serializer):
+    if serializer is None or isinstance(serializer, MonqueSerializer):
+        return serializer
+    return _serializers[serializer]()
+
+
+class MonqueBodyCodec(object):
+    # turns a job's message into the stored body fields and back.  bodies
+    # written without a format tag are plain BSON messages, which is also what
+    # is written when no serializer is chosen and the message is small, so
+    # existing queues and producers keep working unchanged.
+
+    def __init__(self, serializer=None, compression=None, compress_threshold=1024):
+        if compression is not None and compression not in _compressors:
+            raise ValueError("Unknown compression: {0}".format(compression))
+
+        self._serializer = get_serializer(serializer)
+        self._compression = compression
+        self._compress_threshold = compress_threshold
+        self._decoders = dict()
+
+    def encode(self, message, serializer=None):
+        serializer = get_serializer(serializer) or self._serializer
+
+        if serializer is None and self._compression is None:
+            return dict(message = message)
+
+        data = (serializer or BSONSerializer()).dumps(message)
+        format = (serializer or BSONSerializer).format
+
+        if self._compression and len(data) >= self._compress_threshold:
+            data = _compressors[self._compression][0](data)
+            format = "{0}+{1}".format(format, self._compression)
+        elif serializer is None:
+            return dict(message = message)
+
+        return dict(format = format, data = pymongo.binary.Binary(data))
+
+    def to_bytes(self, body):
+        # (format, data) for a body returned by encode
+        if body.get('format') is None:
+            return BSONSerializer.format, BSONSerializer().dumps(body['message'])
+
+        return body['format'], str(body['data'])
+
+    def decode(self, body):
+        format = body.get('format')
+
+        if format is None:
+            return body['message']
+
+        return self._decoder(format)(str(body['data']))
+
+    def _decoder(self, format):
+        if format not in self._decoders:
+            name, _, compression = format.partition('+')
+            loads = _serializers[name]().loads
+
+            if compression:
+                decompress = _compressors[compression][1]
+                self._decoders[format] = lambda data: loads(decompress(data))
+            else:
+                self._decoders[format] = loads
+
+        return self._decoders[format]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+stats.py
+"""
+
+import metrics
+import threading
+import time
+
+
+class MonqueStatsBuffer(object):
+    # merges $inc counters in memory and writes each (collection, spec) pair
+    # out as a single update once flush_every jobs have finished or
+    # flush_interval seconds have passed, whichever comes first.
+
+    def __init__(self, monque, flush_every=100, flush_interval=5):
+        self._monque = monque
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._jobs = 0
+        self._last_flush = time.time()
+
+    def incr(self, collection, spec, upsert=False, **counters):
+        key = (collection, tuple(sorted(spec.items())), upsert)
+
+        with self._lock:
+            merged = self._counters.setdefault(key, dict())
+            for name, value in counters.iteritems():
+                merged[name] = merged.get(name, 0) + value
+
+    def observe(self, metric, value, **labels):
+        # a histogram observation is a handful of counters on the document for
+        # its metric and labels, so it is buffered and merged like any other
+        spec = dict(labels, metric = metric)
+        self.incr('metrics', spec, upsert=True, **metrics.MonqueHistogram.counters(value))
+
+    def job_finished(self):
+        with self._lock:
+            self._jobs += 1
+
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self._jobs >= self._flush_every or time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, dict()
+            self._jobs = 0
+            self._last_flush = time.time()
+
+        for (collection, spec, upsert), inc in counters.iteritems():
+            c = self._monque.get_collection(collection)
+            c.update(dict(spec), {'$inc' : inc}, upsert=upsert, **self._monque.write_concern('stats'))
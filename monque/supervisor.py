@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+supervisor.py
+"""
+
+import logging
+import math
+import metrics
+import multiprocessing
+import os
+import signal
+import time
+import util
+
+
+class MonqueSupervisor(object):
+    # keeps between min_workers and max_workers worker processes on this host
+    # working the same queues: one per jobs_per_worker ready or running jobs, and one
+    # more whenever the recent wait times run past max_wait.  workers are
+    # added straight away but retired one at a time, with SIGQUIT so they
+    # finish their jobs first, and at most once per cooldown seconds.
+    # crashed workers are replaced after a backoff that doubles with each
+    # crash in a row.
+
+    def __init__(self, monque, queues, min_workers=1, max_workers=4, jobs_per_worker=100, max_wait=None, wait_quantile=0.9,
+                 interval=10, cooldown=60, backoff=1, max_backoff=60, drain_timeout=300, worker_options=None, work_interval=5):
+        self._monque = monque
+        self._queues = list(queues)
+        self._min_workers = min_workers
+        self._max_workers = max(min_workers, max_workers)
+        self._jobs_per_worker = jobs_per_worker
+        self._max_wait = max_wait
+        self._wait_quantile = wait_quantile
+        self._interval = interval
+        self._cooldown = cooldown
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._drain_timeout = drain_timeout
+        self._worker_options = dict(worker_options or ())
+        self._work_interval = work_interval
+        self._workers = dict()      # pid: (process, started)
+        self._draining = dict()     # pid: (process, signalled)
+        self._crashes = 0
+        self._restart_at = 0
+        self._scaled_at = 0
+        self._waits = None
+        self._stopping = False
+
+    def run(self):
+        self._register_signal_handlers()
+        util.setprocname("monque: Supervising queues: {0}".format(','.join(self._queues)))
+
+        try:
+            while not self._stopping:
+                self._collect()
+                self._scale(self.target())
+                time.sleep(self._interval)
+        finally:
+            self.stop()
+
+    def stop(self, timeout=None):
+        for pid in self._workers.keys():
+            self._drain(pid)
+
+        deadline = time.time() + (self._drain_timeout if timeout is None else timeout)
+
+        while self._draining and time.time() < deadline:
+            self._collect()
+            time.sleep(0.1)
+
+        for process, signalled in self._draining.values():
+            process.terminate()
+            process.join()
+
+        self._draining.clear()
+
+    def target(self):
+        # the number of workers the queues call for right now.  jobs in flight
+        # count too, or busy workers with nothing left ready would be retired
+        sizes = self._monque.queue_sizes(self._queues)
+        pending = sum(size['ready'] + size['in_flight'] for size in sizes.itervalues())
+        wanted = int(math.ceil(pending / float(self._jobs_per_worker)))
+
+        if self._max_wait is not None:
+            wait = self._recent_wait()
+
+            if wait is not None and wait > self._max_wait:
+                wanted = max(wanted, len(self._workers) + 1)
+
+        return min(max(wanted, self._min_workers), self._max_workers)
+
+    def _recent_wait(self):
+        # the wait_seconds quantile over just the jobs claimed since the last
+        # call, from the difference between two readings of the histogram
+        current = metrics.MonqueHistogram()
+
+        for (metric, labels), histogram in metrics.histograms(self._monque, 'wait_seconds').iteritems():
+            if dict(labels).get('queue') in self._queues:
+                current.merge(histogram)
+
+        previous, self._waits = self._waits, current
+
+        if previous is None:
+            return None
+
+        recent = metrics.MonqueHistogram(
+            dict((bound, n - previous.buckets.get(bound, 0)) for (bound, n) in current.buckets.iteritems()),
+            current.sum - previous.sum,
+            current.count - previous.count
+        )
+        return recent.quantile(self._wait_quantile)
+
+    def _scale(self, target):
+        now = time.time()
+        running = len(self._workers)
+
+        if running < target and now >= self._restart_at:
+            for i in xrange(target - running):
+                self._start()
+            self._scaled_at = now
+        elif running > target and now - self._scaled_at >= self._cooldown:
+            # the newest worker is the one most likely to be idle
+            self._drain(max(self._workers, key=lambda pid: self._workers[pid][1]))
+            self._scaled_at = now
+
+    def _start(self):
+        process = multiprocessing.Process(target=self._work)
+        process.start()
+        self._workers[process.pid] = (process, time.time())
+        logging.info("Supervisor started worker {0} on queues: {1}".format(process.pid, ','.join(self._queues)))
+
+    def _work(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+        options = dict(self._worker_options)
+
+        if options.get('dispatcher') == "gevent":
+            # a plain worker would run gevent jobs inline, one at a time
+            del options['dispatcher']
+            w = self._monque.new_async_worker(queues=self._queues, **options)
+        else:
+            w = self._monque.new_worker(queues=self._queues, **options)
+
+        w.work(self._work_interval)
+
+    def _drain(self, pid):
+        process, started = self._workers.pop(pid)
+
+        try:
+            os.kill(pid, signal.SIGQUIT)
+        except OSError:
+            pass
+
+        self._draining[pid] = (process, time.time())
+        logging.info("Supervisor draining worker {0}".format(pid))
+
+    def _collect(self):
+        now = time.time()
+
+        for pid, (process, started) in self._workers.items():
+            if process.is_alive():
+                continue
+
+            process.join()
+            del self._workers[pid]
+
+            if process.exitcode:
+                # a worker that survived a full backoff period wasn't
+                # crash-looping, so the backoff starts over
+                self._crashes = 1 if now - started >= self._max_backoff else self._crashes + 1
+                delay = min(self._backoff * 2 ** (self._crashes - 1), self._max_backoff)
+                self._restart_at = max(self._restart_at, now + delay)
+                logging.error("Worker {0} exited with {1}, restarting in {2}s".format(pid, process.exitcode, delay))
+
+        for pid, (process, signalled) in self._draining.items():
+            if not process.is_alive():
+                process.join()
+                del self._draining[pid]
+            elif now - signalled >= self._drain_timeout:
+                logging.warn("Worker {0} did not drain within {1}s, terminating".format(pid, self._drain_timeout))
+                process.terminate()
+
+    def _register_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+            signal.signal(signum, lambda num, frame: self._shutdown())
+
+    def _shutdown(self):
+        logging.info("Supervisor shutting down, draining {0} workers.".format(len(self._workers)))
+        self._stopping = True
@@ -6,7 +6,7 @@ util.py
 Created by Kurtiss Hare on 2010-03-12.
 """
 
-_import_cache = dict()
+_registry = dict()
 _setprocname = None
 
 
@@ -14,15 +14,31 @@ def get_toplevel_attrname(obj):
     return "{0.__module__}.{0.__name__}".format(obj)
 
 def get_toplevel_attr(name):
-    global _import_cache
-
-    if not _import_cache.has_key(name):
+    # jobs and job classes are registered by name as they are defined, so
+    # this is normally a single lookup; anything else is imported once and
+    # remembered.
+    try:
+        return _registry[name]
+    except KeyError:
         mod_name, attr_name = name.rsplit('.', 1)
         mod = __import__(str(mod_name), {}, {}, [str(attr_name)])
-        attr = getattr(mod, attr_name)
-        _import_cache[name] = attr
+        return register(getattr(mod, attr_name), name)
+
+def register(obj, name = None):
+    _registry[name or get_toplevel_attrname(obj)] = obj
+    return obj
+
+def registered_modules():
+    return sorted(set(name.rsplit('.', 1)[0] for name in _registry))
+
+def preload(modules):
+    # imports job modules up front so that their @job decorators fill the
+    # registry before a worker forks, leaving children to share it
+    # copy-on-write instead of each importing the modules on first use.
+    for mod_name in modules:
+        __import__(str(mod_name))
 
-    return _import_cache[name]
+    return registered_modules()
 
 def setprocname(name):
     global _setprocname
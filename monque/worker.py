@@ -6,24 +6,79 @@ worker.py
 Created by Kurtiss Hare on 2010-03-12.
 """
 
+import collections
 import datetime
+import errno
+import job
 import logging
 import multiprocessing
 import os
+import pool
+import profiling
 import pymongo.objectid
 import signal
 import socket
+import stats
+import threading
 import time
 import util
 
 class MonqueWorker(object):
-    def __init__(self, monque, queues=None, dispatcher="fork"):
+    def __init__(self, monque, queues=None, dispatcher="fork", prefetch=1, pool_size=4, max_jobs_per_child=None, max_child_rss=None, concurrency=8, queue_weights=None,
+                 status_updates=False, stats_flush_every=100, stats_flush_interval=5,
+                 lease=30, reap=True, ordered=True, preload=None, hooks=None, profile_every=None,
+                 reconcile_every=300):
         self._monque = monque
         self._queues = queues or []
         self._worker_id = None
         self._child = None
+        self._pool = None
         self._shutdown_status = None
         self._dispatcher = dispatcher
+        self._prefetch = prefetch
+        self._prefetched = collections.deque()
+        self._prefetch_lock = threading.Lock()
+        self._concurrency = concurrency
+        self._queue_weights = queue_weights
+        self._status_updates = status_updates
+        self._stats = stats.MonqueStatsBuffer(monque, stats_flush_every, stats_flush_interval)
+        self._lease = lease
+        self._reap = reap
+        self._ordered = ordered
+        self._preload = preload or []
+        self._hooks = dict()
+        self._profile_every = profile_every
+        self._profile_counts = dict()
+        self._profile_lock = threading.Lock()
+        self._reconcile_every = reconcile_every
+        self._next_reconcile = time.time() + (reconcile_every or 0)
+        self._heartbeat_stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._listeners = threading.local()
+        self._pool_options = dict(
+            size        = pool_size,
+            max_jobs    = max_jobs_per_child,
+            max_rss     = max_child_rss,
+        )
+
+        for name, func in (hooks or dict()).iteritems():
+            self.add_hook(name, func)
+
+    def add_hook(self, name, func):
+        # before_claim(worker), before_run(worker, order),
+        # after_run(worker, order) and on_failure(worker, order, error), all
+        # called in the worker process rather than in forked children.
+        if name not in ('before_claim', 'before_run', 'after_run', 'on_failure'):
+            raise ValueError("Unknown hook: {0}".format(name))
+
+        self._hooks.setdefault(name, []).append(func)
+
+    def _run_hooks(self, name, *args):
+        for func in self._hooks.get(name, ()):
+            try:
+                func(self, *args)
+            except Exception:
+                logging.exception("Worker {0._worker_id} {1} hook failed.".format(self, name))
     
     def register_worker(self):
         self._worker_id = pymongo.objectid.ObjectId()
@@ -33,81 +88,346 @@ class MonqueWorker(object):
             _id         = self._worker_id,
             hostname    = socket.gethostname(),
             pid         = os.getpid(),
-            start_time  = None,
-            job         = None,
+            queues      = list(self._queues),
+            lease       = self._lease,
+            heartbeat   = datetime.datetime.utcnow(),
+            jobs        = dict(),
             retried     = 0,
             processed   = 0,
             failed      = 0
-        ))
+        ), **self._monque.write_concern('heartbeats'))
+
+    def heartbeat(self):
+        wc = self._monque.get_collection('workers')
+        wc.update(dict(_id = self._worker_id), {'$set' : dict(heartbeat = datetime.datetime.utcnow())}, **self._monque.write_concern('heartbeats'))
+        self._monque.renew(self._queues, self._worker_id, self._lease)
+
+        if self._reap:
+            self._monque.reap(stale_after=self._lease)
+
+        if self._reconcile_every and time.time() >= self._next_reconcile:
+            # buffered counts would land on top of the recount
+            self._stats.flush()
+            self._monque.reconcile_queue_sizes(self._queues)
+
+            if self._monque.limits.configured():
+                self._monque.limits.reconcile()
+            self._next_reconcile = time.time() + self._reconcile_every
+
+    def _heartbeat_target(self):
+        # renews the leases on every job this worker holds a few times per
+        # lease period, so a live worker never loses a job however long it
+        # runs while a dead one gives its jobs up within one lease.
+        while not self._heartbeat_stop.wait(self._lease / 3.0):
+            try:
+                self.heartbeat()
+            except Exception:
+                logging.exception("Worker {0._worker_id} failed to heartbeat.".format(self))
 
     def unregister_worker(self):
         wc = self._monque.get_collection('workers')
-        wc.remove(dict(_id = self._worker_id))    
+        wc.remove(dict(_id = self._worker_id), **self._monque.write_concern('heartbeats'))
     
+    def preload(self):
+        # import the job modules before the first fork, see util.preload
+        if self._preload:
+            modules = util.preload(self._preload)
+            logging.info("Worker preloaded jobs from: {0}".format(', '.join(modules)))
+
     def work(self, interval=5):
+        self.preload()
         self.register_worker()
         self._register_signal_handlers()
+        self._monque.buffer_counts(self._stats)
+        self._start_heartbeat()
         
         util.setprocname("monque: Starting")
+
+        if self._dispatcher == "pool":
+            self._pool = pool.MonqueWorkerPool(self, **self._pool_options)
+            self._pool.start()
         
         try:
-            while not self._shutdown_status:
-                worked = self._work_once()
+            if self._dispatcher == "threads":
+                self._work_threaded(interval)
+            else:
+                while not self._shutdown_status:
+                    worked = self._work_once()
 
-                if interval == 0:
-                    break
+                    if interval == 0:
+                        break
 
-                if not worked:
-                    util.setprocname("monque: Waiting on queues: {0}".format(','.join(self._queues)))
-                    time.sleep(interval)
+                    if not worked:
+                        util.setprocname("monque: Waiting on queues: {0}".format(','.join(self._queues)))
+                        self._wait(interval)
         finally:
+            if self._pool:
+                self._stop_pool()
+            self.release_prefetched()
+            self._monque.buffer_counts(None)
+            self._stats.flush()
+            self._stop_heartbeat()
             self.unregister_worker()
+
+    def _work_threaded(self, interval):
+        # every thread runs the whole dequeue/working_on/process/done_working
+        # cycle, so claims and bookkeeping writes overlap as well as the jobs.
+        threads = [threading.Thread(target=self._thread_target, args=(interval,)) for i in xrange(self._concurrency)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        util.setprocname("monque: Running {0} threads on queues: {1}".format(len(threads), ','.join(self._queues)))
+
+        # join with a timeout so the main thread keeps servicing signals; on an
+        # immediate shutdown in-flight jobs are abandoned to their lease.
+        while self._shutdown_status != "immediate" and any(t.is_alive() for t in threads):
+            for thread in threads:
+                thread.join(0.1)
+
+    def _thread_target(self, interval):
+        while not self._shutdown_status:
+            worked = self._work_once()
+
+            if interval == 0:
+                break
+
+            if not worked:
+                self._idle(interval)
+
+    def _start_heartbeat(self):
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_target)
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def _stop_heartbeat(self):
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join()
+
+    def _wait(self, interval):
+        if self._pool and self._pool.busy():
+            self._wait_pooled(interval)
+        else:
+            self._idle(interval)
+
+    def _wait_pooled(self, interval, step=0.1):
+        # waits on the busy children, but while any child is free and the
+        # monque publishes notifications, breaks off every `step` seconds to
+        # check for a push, so a long job doesn't hold up the next one.
+        listener = self._listener()
+
+        if not listener or not self._pool.idle():
+            self._collect_pool(timeout=interval)
+            return
+
+        deadline = time.time() + interval
+
+        while not self._wakeup.is_set():
+            remaining = deadline - time.time()
+
+            if self._collect_pool(timeout=max(0, min(step, remaining))) or remaining <= 0 or listener.wait(0):
+                return
+
+    def _idle(self, interval):
+        # block until a job is pushed onto one of our queues when the monque
+        # publishes notifications, otherwise just sleep out the interval.
+        self._stats.maybe_flush()
+        listener = self._listener()
+
+        if listener:
+            listener.wait(interval, self._wakeup)
+        else:
+            self._wakeup.wait(interval)
+
+    def _listener(self):
+        if not hasattr(self._listeners, 'listener'):
+            self._listeners.listener = self._monque.listen(self._queues)
+
+        return self._listeners.listener
             
     def _work_once(self):
-        order = self._monque.dequeue(self._queues, grabfor=60*60)
+        if self._pool:
+            return self._work_once_pooled()
+
+        order = self._next_order()
 
         if not order:
             return False
 
-        if order:
+        self._run_order(order)
+        return True
+
+    def _next_order(self):
+        if self._hooks:
+            self._run_hooks('before_claim')
+
+        order = self._claim_order()
+
+        if order and isinstance(order.job, job.MonqueBatchJob):
+            order = self._fill_batch(order)
+
+        return order
+
+    def _claim_order(self):
+        if self._prefetch <= 1:
+            return self._monque.dequeue(self._queues, grabfor=self._lease, weights=self._queue_weights, owner=self._worker_id, ordered=self._ordered)
+
+        with self._prefetch_lock:
+            if not self._prefetched:
+                self._prefetched.extend(self._monque.dequeue_many(self._queues, self._prefetch, grabfor=self._lease, owner=self._worker_id, ordered=self._ordered))
+
+            if self._prefetched:
+                return self._prefetched.popleft()
+
+    def _fill_batch(self, order):
+        # gathers more pending calls of the same batch_job until there are
+        # max_size of them or max_wait seconds have passed
+        orders = [order]
+        deadline = time.time() + order.job.max_wait
+
+        while True:
+            orders.extend(self._monque.dequeue_batch(order.queue, order.job.batch_key(), order.job.max_size - len(orders),
+                grabfor=self._lease, owner=self._worker_id, ordered=self._ordered))
+            remaining = deadline - time.time()
+
+            if len(orders) >= order.job.max_size or remaining <= 0 or self._shutdown_status:
+                break
+
+            self._idle(min(remaining, 1.0))
+
+        return job.MonqueBatchOrder(orders)
+
+    def release_prefetched(self):
+        while self._prefetched:
+            order = self._prefetched.popleft()
+            self._monque.update(order.queue, order.job_id, delay=0)
+
+    def _run_order(self, order):
+        try:
+            self.working_on(order)
+            self.process(order)
+        except Exception, e:
+            self._finish_order(order, e)
+        else:
+            self._finish_order(order)
+
+    def _work_once_pooled(self):
+        worked = self._collect_pool(timeout=0)
+
+        while self._pool.idle() and not self._shutdown_status:
+            order = self._next_order()
+
+            if not order:
+                break
+
             try:
                 self.working_on(order)
-                self.process(order)
             except Exception, e:
-                self._handle_job_failure(order, e)
+                self._finish_order(order, e)
+            else:
+                pid = self._pool.submit(order)
+                util.setprocname("monque: Handed {0} to {1} at {2}".format(order.queue, pid, time.time()))
+
+            worked = True
+
+        return worked
+
+    def _collect_pool(self, timeout=None):
+        results = self._pool.collect(timeout)
+
+        for order, error in results:
+            self._finish_order(order, error and Exception(error))
+
+        return bool(results)
+
+    def _stop_pool(self):
+        if self._shutdown_status == "immediate":
+            self._pool.kill_busy()
+
+        while self._pool.busy():
+            self._collect_pool()
+
+        self._pool.stop()
+        self._pool = None
+
+    def _finish_order(self, order, error=None):
+        if getattr(order, 'profile_stats', None):
+            self._stats.incr('profiles', dict(func = order.job.name), upsert=True, **profiling.counters(order.profile_stats))
+
+        if isinstance(order, job.MonqueBatchOrder):
+            for member, member_error in order.split(error):
+                self._finish_order(member, member_error)
+            return
+
+        try:
+            if error:
+                self._handle_job_failure(order, error)
             else:
                 self.done_working(order)
-            finally:
+        finally:
+            if self._status_updates:
                 c = self._monque.get_collection('workers')
                 c.update(dict(_id = self._worker_id), {
-                    '$set' : dict(
-                        start_time  = None,
-                        job         = None,
-                    )
-                })
+                    '$unset' : {'jobs.{0}'.format(order.job_id) : 1}
+                }, **self._monque.write_concern('heartbeats'))
 
-        return True
+            self._stats.job_finished()
         
     def working_on(self, order):
-        c = self._monque.get_collection('workers')
+        if self._profile_every:
+            order.profile = self._sample(order.job.name)
+
+        if isinstance(order, job.MonqueBatchOrder):
+            for member in order.orders:
+                self._job_started(member)
+        else:
+            self._job_started(order)
 
-        c.update(dict(_id = self._worker_id), {
-            '$set' : dict(
-                start_time  = datetime.datetime.utcnow(),
-                job         = order.job.__serialize__(),
-            )
-        })
+    def _sample(self, name):
+        # profiles the first run of each job function and every
+        # profile_every-th after that
+        with self._profile_lock:
+            runs = self._profile_counts[name] = self._profile_counts.get(name, 0) + 1
+
+        return (runs - 1) % self._profile_every == 0
+
+    def _job_started(self, order):
+        if self._status_updates:
+            c = self._monque.get_collection('workers')
+
+            c.update(dict(_id = self._worker_id), {
+                '$set' : {'jobs.{0}'.format(order.job_id) : dict(
+                    start_time  = datetime.datetime.utcnow(),
+                    job         = order.job.__serialize__(),
+                )}
+            }, **self._monque.write_concern('heartbeats'))
         
-        c = self._monque.get_collection('queue_stats')
         order.mark_start()
 
+        wait = order.wait_time()
+        if wait is not None:
+            self._stats.observe('wait_seconds', max(wait, 0), queue = order.queue, func = order.job.name)
+
+        if self._hooks:
+            self._run_hooks('before_run', order)
+
     def process(self, order):
         if self._dispatcher == "fork":
-            child = self._child = multiprocessing.Process(target=self._process_target, args=(order,))
+            # the child hands the job's return value and any profile back
+            # over a pipe when the parent has a use for them
+            reader, writer = multiprocessing.Pipe(False) if self._wants_result(order) else (None, None)
+
+            child = self._child = multiprocessing.Process(target=self._process_target, args=(order, writer))
             self._child.start()
 
             util.setprocname("monque: Forked {0} at {1}".format(self._child.pid, time.time()))
 
+            if reader:
+                writer.close()
+                order.result, order.profile_stats = self._receive_result(reader) or (None, None)
+
             while True:
                 try:
                     child.join()
@@ -124,54 +444,90 @@ class MonqueWorker(object):
         else:
             self.dispatch(order)
     
+    def _receive_result(self, reader):
+        # read before joining, a large result would otherwise fill the pipe
+        # and leave the child blocked on it forever
+        try:
+            while True:
+                try:
+                    return reader.recv()
+                except EOFError:
+                    return None # the child failed or was killed
+                except IOError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            reader.close()
+
+    def _wants_result(self, order):
+        # batches always report back, their results carry per-call failures
+        return self._monque.results or getattr(order, 'profile', False) or isinstance(order.job, job.MonqueBatch)
+
     def done_working(self, order):
         self._monque.remove(order.queue, order.job_id)
+        self._monque.store_result(order.queue, order.job_id, value=getattr(order, 'result', None))
         self.processed(order)
+
+        if self._hooks:
+            self._run_hooks('after_run', order)
     
-    def _process_target(self, order):
+    def _process_target(self, order, writer=None):
         self.reset_signal_handlers()
         self.dispatch(order)
 
+        if writer:
+            writer.send((order.result, getattr(order, 'profile_stats', None)))
+
     def dispatch(self, order):
         util.setprocname("monque: Processing {0} since {1}".format(order.queue, time.time()))
-        order.job.run()
+
+        if getattr(order, 'profile', False):
+            order.result, order.profile_stats = profiling.run_profiled(order.job)
+        else:
+            order.result = order.job.run()
     
     def _handle_job_failure(self, order, e):
         import traceback
         logging.warn("Job failed ({0}): {1}\n{2}".format(order.job, str(e), traceback.format_exc()))
 
+        if self._hooks:
+            self._run_hooks('on_failure', order, e)
+
+        order.fail(e)
+
         if order.retries > 0:
-            order.fail(e)
             self._monque.update(order.queue, order.job_id, delay=min(2**(len(order.failures)-1), 60), failure=str(e))
 
-            wc = self._monque.get_collection('workers')
-            wc.update(dict(_id = self._worker_id), {'$inc' : dict(retried = 1)})
-            qs = self._monque.get_collection('queue_stats')
-            qs.update(dict(queue = order.queue), {'$inc' : dict(retries=1)}, upsert=True)
+            self._stats.incr('workers', dict(_id = self._worker_id), retried = 1)
+            self._stats.incr('queue_stats', dict(queue = order.queue), upsert=True, retries = 1)
+            self._stats.observe('run_seconds', order.mark_completion().total_seconds(), queue = order.queue, func = order.job.name)
         else:
+            self._monque.bury(order.queue, order.job_id, failure=str(e))
+            self._monque.store_result(order.queue, order.job_id, error=str(e))
             self.failed(order)
     
     def processed(self, order):
-        wc = self._monque.get_collection('workers')
-        wc.update(dict(_id = self._worker_id), {'$inc' : dict(processed = 1)})
-        duration = order.mark_completion()
-        qs = self._monque.get_collection('queue_stats')
-        qs.update(dict(queue = order.queue), {'$inc' : dict(successes=1, success_duration=duration.seconds)}, upsert=True)
+        self._stats.incr('workers', dict(_id = self._worker_id), processed = 1)
+        duration = order.mark_completion().total_seconds()
+        self._stats.incr('queue_stats', dict(queue = order.queue), upsert=True, successes=1, success_duration=duration)
+        self._stats.observe('run_seconds', duration, queue = order.queue, func = order.job.name)
         # qs.update(dict(queue = order.queue), {'$inc' : dict(size=-1)}, upsert=True)
         # qs.update(dict(queue = order.queue), {'$inc' : dict(success_duration=duration.seconds)}, upsert=True)
     
     def failed(self, order):
-        wc = self._monque.get_collection('workers')
-        wc.update(dict(_id = self._worker_id), {'$inc' : dict(failed = 1)})
-        duration = order.mark_completion()
-        qs = self._monque.get_collection('queue_stats')
-        qs.update(dict(queue = order.queue), {'$inc' : dict(failures=1, failure_duration=duration.seconds)}, upsert=True)
+        self._stats.incr('workers', dict(_id = self._worker_id), failed = 1)
+        duration = order.mark_completion().total_seconds()
+        self._stats.incr('queue_stats', dict(queue = order.queue), upsert=True, failures=1, failure_duration=duration)
+        self._stats.observe('run_seconds', duration, queue = order.queue, func = order.job.name)
         # qs.update(dict(queue = order.queue), {'$inc' : dict(size=-1)}, upsert=True)
         # qs.update(dict(queue = order.queue), {'$inc' : dict(failure_duration=duration.seconds)}, upsert=True)
 
     def _register_signal_handlers(self):
         signal.signal(signal.SIGQUIT,   lambda num, frame: self._shutdown(graceful=True))
-        if self._dispatcher == "fork":
+        if self._dispatcher in ("threads", "gevent"):
+            signal.signal(signal.SIGTERM,   lambda num, frame: self._shutdown())
+            signal.signal(signal.SIGINT,    lambda num, frame: self._shutdown())
+        elif self._dispatcher in ("fork", "pool"):
             signal.signal(signal.SIGTERM,   lambda num, frame: self._shutdown())
             signal.signal(signal.SIGINT,    lambda num, frame: self._shutdown())
             signal.signal(signal.SIGUSR1,   lambda num, frame: self._kill_child())
@@ -186,12 +542,17 @@ class MonqueWorker(object):
         if graceful:
             logging.info("Worker {0._worker_id} shutting down gracefully.".format(self))
             self._shutdown_status = "graceful"
+            self._wakeup.set()
         else:
             logging.info("Worker {0._worker_id} shutting down immediately.".format(self))
             self._shutdown_status = "immediate"
+            self._wakeup.set()
             self._kill_child()
     
     def _kill_child(self):
+        if self._pool:
+            self._pool.kill_busy()
+
         if self._child:
             logging.info("Killing child {0}".format(self._child))
             
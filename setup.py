@@ -20,7 +20,8 @@ setup(
     author              = 'Kurtiss Hare',
     author_email        = 'kurtiss@kurtiss.org',
     url                 = 'http://github.com/kurtiss/monque',
-    packages            = ['monque'],
+    packages            = ['monque', 'monque.backends'],
+    scripts             = ['bin/monque'],
     requires            = ['pymongo'],
     install_requires    = [],
     classifiers = [
@@ -7,7 +7,9 @@ Created by Kurtiss Hare on 2010-03-14.
 Copyright (c) 2010 Medium Entertainment, Inc. All rights reserved.
 """
 
+import datetime
 import pymongo
+import pymongo.objectid
 import monque
 import multiprocessing
 import os
@@ -19,6 +21,18 @@ import unittest
 
 retry_job_limit = 3
 
+def new_storage():
+    # MONQUE_TEST_BACKEND=memory|sqlite runs the suite without a mongod
+    backend = os.environ.get('MONQUE_TEST_BACKEND', 'mongo')
+
+    if backend == 'memory':
+        return monque.MemoryBackend()
+    elif backend == 'sqlite':
+        path = os.path.join(tempfile.gettempdir(), 'monque-test.sqlite')
+        return monque.SQLiteBackend(path)
+    else:
+        return pymongo.Connection()['monque-test']
+
 def do_set_test_values(tmpfile, *test_args, **test_kwargs):
     with open(tmpfile, "w+") as f:
         f.write(pickle.dumps((test_args, test_kwargs)))
@@ -43,6 +57,22 @@ def item_set(values):
 def set_test_values(*args, **kwargs):
     do_set_test_values(*args, **kwargs)
 
+@monque.job()
+def add(a, b):
+    return a + b
+
+batch_sizes = []
+
+@monque.batch_job(max_size = 3)
+def add_batch(calls):
+    batch_sizes.append(len(calls))
+    return [a + b if b is not None else ValueError("b is None") for (a, b) in calls]
+
+@monque.batch_job(max_size = 1)
+def add_single(calls):
+    batch_sizes.append(len(calls))
+    return [a + b for (a, b) in calls]
+
 @monque.job()
 def long_job(*args, **kwargs):
     time.sleep(2)
@@ -65,8 +95,7 @@ class TestMonque(unittest.TestCase):
         import logging
         logging.basicConfig(level=logging.ERROR)
 
-        connection = pymongo.Connection()
-        self.monque = monque.Monque(connection['monque-test'], default_queue = 'test_queue')
+        self.monque = monque.Monque(new_storage(), default_queue = 'test_queue')
         self.tmpfile = tempfile.mkstemp()[1]
         self.monque.clear()
     
@@ -105,6 +134,238 @@ class TestMonque(unittest.TestCase):
         job = self.monque.pop("test_queue")
         self.failUnlessEqual(job['body'], "alf")
 
+    def testPopMany(self):
+        self.monque.push_many("test_queue", ["alf", "bet", "gim"])
+        jobs = self.monque.pop_many("test_queue", 2, grabfor=5)
+        self.failUnlessEqual(len(jobs), 2)
+        jobs.extend(self.monque.pop_many("test_queue", 2, grabfor=5))
+        self.failUnlessEqual(set(job['body'] for job in jobs), set(["alf", "bet", "gim"]))
+        self.failUnlessEqual(self.monque.pop_many("test_queue", 2), [])
+
+    def testPopManyRace(self):
+        class RacingMonque(monque.Monque):
+            # another claimant takes every candidate between the find and the update
+            rival = None
+
+            def _claim_candidates(self, *args):
+                found = monque.Monque._claim_candidates(self, *args)
+
+                if self.rival:
+                    rival, self.rival = self.rival, None
+                    rival.pop_many("test_queue", len(found), grabfor=5)
+
+                return found
+
+        racing = RacingMonque(self.monque.mongodb, default_queue = 'test_queue')
+        racing.push_many("test_queue", ["alf", "bet", "gim", "dal"])
+
+        racing.rival = self.monque
+        self.failUnlessEqual([job['body'] for job in racing.pop_many("test_queue", 2, grabfor=5)], ["gim", "dal"])
+
+        racing.push_many("test_queue", ["he", "vav", "zay"])
+        racing.rival = self.monque
+        self.failUnlessEqual(len(racing.pop_many("test_queue", 2, grabfor=5, ordered=False)), 1)
+
+    def testNotify(self):
+        notifying = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', notify = True)
+        listener = notifying.listen(["test_queue"])
+        listener.wait(0)
+
+        self.failIf(listener.wait(0.1))
+        notifying.push("test_queue", "alf")
+        self.failUnless(listener.wait(1))
+        notifying.push("test_queue", "bet", delay=5)
+        self.failIf(listener.wait(0.1))
+        notifying.push("other_queue", "gim")
+        self.failIf(listener.wait(0.1))
+
+        # signals sent before a listener starts don't wake it
+        self.failIf(notifying.listen(["test_queue"]).wait(0.1))
+        notifying.clear(["other_queue"])
+
+    def testSharedPriorities(self):
+        shared = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', shared = True, priorities = dict(urgent = 10))
+        shared.clear(["test_queue", "urgent"])
+
+        shared.push("test_queue", "alf")
+        shared.push("urgent", "bet")
+        self.failUnlessEqual(shared.pop_any(["test_queue", "urgent"])['body'], "bet")
+        self.failUnlessEqual(shared.pop("urgent"), None)
+        self.failUnlessEqual(shared.pop_any(["test_queue", "urgent"])['body'], "alf")
+
+    def testReap(self):
+        wid = pymongo.objectid.ObjectId()
+        wc = self.monque.get_collection('workers')
+        wc.insert(dict(_id = wid, queues = ["test_queue"], heartbeat = datetime.datetime.utcnow() - datetime.timedelta(seconds=120)))
+
+        self.monque.push("test_queue", "alf")
+        self.failUnlessEqual(self.monque.pop("test_queue", grabfor=60, owner=wid)['body'], "alf")
+        self.failUnlessEqual(self.monque.pop("test_queue"), None)
+
+        self.failUnlessEqual(self.monque.reap(stale_after=60), [wid])
+        self.failUnlessEqual(self.monque.pop("test_queue")['body'], "alf")
+        self.failUnlessEqual(wc.find_one(wid), None)
+
+        # a worker with a longer lease is judged by its own
+        wc.insert(dict(_id = wid, queues = ["test_queue"], lease = 300, heartbeat = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)))
+        self.monque.push("test_queue", "bet")
+        self.monque.pop("test_queue", grabfor=300, owner=wid)
+
+        self.failUnlessEqual(self.monque.reap(stale_after=30), [])
+        self.failUnlessEqual(self.monque.pop("test_queue"), None)
+        self.failIfEqual(wc.find_one(wid), None)
+        wc.remove(dict(_id = wid))
+
+    def testPartitionedPop(self):
+        partitioned = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', claim_slots = 4)
+        partitioned.push_many("test_queue", ["alf", "bet", "gim"])
+        self.monque.push("test_queue", "dal")
+
+        # a claim only looks in its own window of slots, and every slot has
+        # been covered after two claims
+        jobs = [partitioned.pop("test_queue", ordered=False) for i in range(8)]
+        self.failUnlessEqual(set(job['body'] for job in jobs if job), set(["alf", "bet", "gim", "dal"]))
+        self.failUnlessEqual(partitioned.pop("test_queue"), None)
+
+    def testDeadLetters(self):
+        import tests
+
+        self.monque.clear()
+        self.monque.purge_dead("test_queue")
+
+        handle = self.monque.enqueue(tests.add(1, None), retries = 2)
+
+        for i in range(2):
+            self.monque.update("test_queue", handle.job_id, delay = 0)
+            self.monque.new_worker(dispatcher = "threads", concurrency = 1).work(interval = 0)
+
+        dead = list(self.monque.get_dead_collection("test_queue").find())
+        self.failUnlessEqual(len(dead), 1)
+        self.failUnlessEqual(len(dead[0]['failures']), 2)
+        self.failUnlessEqual(self.monque.pop("test_queue"), None)
+
+        self.failUnlessEqual(self.monque.requeue_dead("test_queue", retries = 1), [str(dead[0]['_id'])])
+        self.failUnlessEqual(self.monque.get_dead_collection("test_queue").count(), 0)
+        self.failUnlessEqual(self.monque.dequeue().job, tests.add(1, None).job)
+
+    def testQueueSizes(self):
+        self.monque.clear()
+        self.monque.purge_dead("test_queue")
+
+        for n in range(4):
+            self.monque.push("test_queue", n)
+        self.monque.push("test_queue", "later", delay = 60)
+
+        claimed = self.monque.pop("test_queue", grabfor = 60, owner = "worker")
+        self.monque.pop("test_queue")
+        self.monque.bury("test_queue", self.monque.pop("test_queue", grabfor = 60, owner = "worker")['_id'])
+
+        expected = dict(test_queue = dict(ready = 1, delayed = 1, in_flight = 1, failed = 1))
+        self.failUnlessEqual(self.monque.queue_sizes(["test_queue"]), expected)
+
+        self.monque.get_collection('queue_stats').update(dict(queue = "test_queue"), {'$inc' : dict(size = 10)})
+        self.monque.reconcile_queue_sizes(["test_queue"])
+        self.failUnlessEqual(self.monque.queue_sizes(["test_queue"]), expected)
+
+        self.monque.remove("test_queue", claimed['_id'])
+        self.failUnlessEqual(self.monque.queue_sizes(["test_queue"])["test_queue"]["in_flight"], 0)
+
+        # only writes that actually remove or release a leased job count
+        _id = self.monque.push("test_queue", "gim")
+        self.monque.update("test_queue", _id, delay = 0)
+        self.monque.remove("test_queue", _id)
+        self.monque.remove("test_queue", _id)
+        self.monque.pop("test_queue", grabfor = 60)
+        expected = dict(test_queue = dict(ready = 0, delayed = 1, in_flight = 1, failed = 1))
+        self.failUnlessEqual(self.monque.queue_sizes(["test_queue"]), expected)
+
+    def testLimits(self):
+        import tests
+
+        self.monque.clear(["test_queue", "other_queue"])
+        self.monque.set_limit(queue = "test_queue", max_concurrency = 1)
+        self.monque.set_limit(func = "tests.add", rate = 0.01, burst = 2)
+
+        try:
+            for queue in ("test_queue", "test_queue", "other_queue"):
+                self.monque.enqueue(tests.set_test_values(self.tmpfile), queue = queue)
+
+            first = self.monque.dequeue(["test_queue", "other_queue"], grabfor = 60)
+            self.failUnlessEqual(first.queue, "test_queue")
+            self.failUnlessEqual(self.monque.dequeue(["test_queue", "other_queue"], grabfor = 60).queue, "other_queue")
+            self.failUnlessEqual(self.monque.dequeue(["test_queue"], grabfor = 60), None)
+
+            self.monque.remove("test_queue", first.job_id)
+            self.failUnlessEqual(self.monque.limits.collection().find_one(dict(_id = "queue:test_queue"))['running'], 0)
+            self.failIfEqual(self.monque.pop("test_queue", grabfor = 60), None)
+
+            self.monque.enqueue_many([tests.add(n, n) for n in range(3)], queue = "other_queue")
+            self.monque.enqueue(tests.set_test_values(self.tmpfile), queue = "other_queue")
+            claimed = [self.monque.pop("other_queue") for n in range(4)]
+            self.failUnlessEqual(len([row for row in claimed if row]), 3)
+            self.failUnlessEqual(self.monque.get_queue_collection("other_queue").find(dict(func = "tests.add")).count(), 1)
+        finally:
+            self.monque.remove_limit(queue = "test_queue")
+            self.monque.remove_limit(func = "tests.add")
+
+    def testSupervisorTarget(self):
+        import monque.supervisor
+
+        supervisor = monque.supervisor.MonqueSupervisor(self.monque, ["test_queue"], min_workers = 1, max_workers = 3, jobs_per_worker = 2)
+        self.failUnlessEqual(supervisor.target(), 1)
+
+        self.monque.push_many("test_queue", range(3))
+        self.failUnlessEqual(supervisor.target(), 2)
+
+        self.monque.push_many("test_queue", range(10))
+        self.failUnlessEqual(supervisor.target(), 3)
+
+        # busy workers are kept on while their jobs are in flight
+        self.monque.clear()
+        self.monque.push_many("test_queue", range(4))
+        self.monque.pop_many("test_queue", 4, grabfor = 60)
+        self.failUnlessEqual(supervisor.target(), 2)
+
+    def testWriteConcerns(self):
+        tuned = monque.Monque(self.monque.mongodb, default_queue = 'test_queue',
+            write_concerns = dict(jobs = dict(safe = True), claims = dict(safe = True), stats = dict(safe = False)),
+            read_preferences = dict(stats = "secondary"))
+
+        self.failUnlessEqual(tuned.write_concern('jobs'), dict(safe = True))
+        self.failUnlessEqual(tuned.write_concern('heartbeats'), dict())
+
+        _id = tuned.push("test_queue", "alf")
+        self.failUnlessEqual(tuned.pop("test_queue", grabfor = 60)['body'], "alf")
+        self.failUnlessEqual(tuned.queue_sizes(["test_queue"])["test_queue"]["in_flight"], 1)
+        tuned.remove("test_queue", _id)
+        self.failUnlessEqual(tuned.queue_sizes(["test_queue"])["test_queue"]["in_flight"], 0)
+
+    def testOffloadedPayloads(self):
+        import tests
+
+        offloading = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', offload_threshold = 256)
+        offloading.clear()
+        payloads = offloading.get_collection('payloads')
+        payloads.remove()
+
+        small = offloading.enqueue(tests.add(1, 2))
+        large = offloading.enqueue(tests.add("x" * 1000, "y"))
+        self.failUnlessEqual(payloads.count(), 1)
+
+        row = offloading.get_queue_collection("test_queue").find_one(dict(_id = pymongo.objectid.ObjectId(large.job_id)))
+        self.failIf('message' in row['body'] or 'data' in row['body'])
+
+        orders = [offloading.dequeue(grabfor = 60) for i in range(2)]
+        self.failUnlessEqual(sorted(order.job.run() for order in orders), [3, "x" * 1000 + "y"])
+
+        for order in orders:
+            offloading.remove(order.queue, order.job_id)
+        self.failUnlessEqual(payloads.count(), 0)
+
+        for i in range(3):
+            offloading.enqueue(tests.add("x" * 1000, "z"), unique = True)
+        self.failUnlessEqual(payloads.count(), 1)
+
     def testUpdate(self):
         _id = self.monque.push("test_queue", "alf")
         self.monque.update("test_queue", _id, failure="cats")
@@ -116,6 +377,25 @@ class TestMonque(unittest.TestCase):
         job = self.monque.pop("test_queue")
         self.failUnlessEqual(job['body'], "alf")
     
+    def testPushMany(self):
+        ids = self.monque.push_many("test_queue", ["alf", "bet", "gim"], chunk_size=2)
+        self.failUnlessEqual(len(ids), 3)
+        bodies = set(self.monque.pop("test_queue")['body'] for i in range(3))
+        self.failUnlessEqual(bodies, set(["alf", "bet", "gim"]))
+        self.failUnlessEqual(self.monque.pop("test_queue"), None)
+
+    def testEnqueueMany(self):
+        import tests
+
+        enqueued = [tests.set_test_values(self.tmpfile, i) for i in range(5)]
+        ids = self.monque.enqueue_many(enqueued, chunk_size=2)
+        self.failUnlessEqual(len(set(ids)), 5)
+
+        dequeued = [self.monque.dequeue() for i in range(5)]
+        for order in enqueued:
+            self.failUnless(order in dequeued)
+        self.failUnlessEqual(self.monque.dequeue(), None)
+
     def testJobs(self):
         import tests
 
@@ -137,6 +417,50 @@ class TestMonque(unittest.TestCase):
         dequeued.job.run()
         self.failUnlessTestValuesEqual(args, kwargs)
 
+    def testUniqueJobs(self):
+        import tests
+
+        self.monque.clear()
+
+        first = self.monque.push("test_queue", "first", unique_key = "abc")
+        self.failUnlessEqual(self.monque.push("test_queue", "second", unique_key = "abc"), first)
+        self.failUnlessEqual(self.monque.pop("test_queue", grabfor = 60)['body'], "first")
+        self.failIfEqual(self.monque.push("test_queue", "third", unique_key = "abc"), first)
+
+        self.monque.clear()
+
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 1), unique = True)
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 1), unique = True)
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 2), unique = lambda tmpfile, n: tmpfile, on_duplicate = "replace")
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 3), unique = lambda tmpfile, n: tmpfile, on_duplicate = "replace")
+        self.monque.enqueue_many([tests.set_test_values(self.tmpfile, n % 2) for n in range(4)], unique = True)
+
+        dequeued = [self.monque.dequeue() for i in range(4)]
+        self.failUnlessEqual(dequeued[-1], None)
+        self.failUnlessEqual(sorted(order.job._func_args[1] for order in dequeued[:-1]), [0, 1, 3])
+
+    def testRegistry(self):
+        import tests
+
+        self.failUnless('tests' in monque.util.preload(['tests']))
+        self.failUnless(monque.util.get_toplevel_attr('tests.set_test_values') is tests.set_test_values.undecorated)
+        self.failUnless(monque.util.get_toplevel_attr('monque.job.MonqueJob') is monque.MonqueJob)
+
+    def testSerializers(self):
+        import tests
+
+        compact = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', serializer = 'pickle', compression = 'zlib', compress_threshold = 16)
+
+        enqueued = tests.set_test_values(self.tmpfile, "x" * 100)
+        compact.enqueue(enqueued)
+        plain = tests.set_test_values(self.tmpfile, 1)
+        self.monque.enqueue(plain)
+
+        # both formats come back out of the same queue
+        dequeued = [self.monque.dequeue(), self.monque.dequeue()]
+        self.failUnless(enqueued in dequeued)
+        self.failUnless(plain in dequeued)
+
     def testWorker(self):
         import tests
     
@@ -151,6 +475,221 @@ class TestMonque(unittest.TestCase):
 
         self.failUnlessTestValuesEqual(args, kwargs)    
      
+    def testPoolWorker(self):
+        import tests
+
+        args = (1,)
+        kwargs = dict(a = 2)
+
+        self.monque.clear()
+
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, *args, **kwargs))
+        worker = self.monque.new_worker(dispatcher = "pool", pool_size = 2, max_jobs_per_child = 1, preload = ['tests'])
+        worker.work(interval = 0)
+
+        self.failUnlessTestValuesEqual(args, kwargs)
+
+    def testResults(self):
+        import tests
+
+        m = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', results = True, notify = True)
+        m.clear()
+
+        handle = m.enqueue(tests.add(1, 2))
+        self.failUnlessRaises(monque.MonqueResultTimeout, handle.get, 0.1)
+        m.new_worker(dispatcher = "fork").work(interval = 0)
+        self.failUnlessEqual(handle.get(5), 3)
+
+        handle = m.enqueue(tests.add(1, None), retries = 1)
+        m.new_worker(dispatcher = "threads", concurrency = 1).work(interval = 0)
+        self.failUnlessRaises(monque.MonqueJobFailed, handle.get, 5)
+
+        handle = self.monque.enqueue(tests.add(1, 2))
+        self.failUnlessRaises(ValueError, handle.get, 5)
+
+        if monque.async_worker.gevent is not None:
+            import gevent
+
+            # waiting on a result leaves the hub free for other greenlets
+            pending = m.enqueue(tests.add(2, 3)).async_result(0.5)
+            start = time.time()
+            gevent.sleep(0.1)
+            self.failUnless(time.time() - start < 0.4)
+            self.failUnlessRaises(monque.MonqueResultTimeout, pending.get)
+
+    def testBatchJobs(self):
+        import tests
+
+        m = monque.Monque(self.monque.mongodb, default_queue = 'test_queue', results = True)
+        m.clear()
+        m.purge_dead("test_queue")
+        del tests.batch_sizes[:]
+
+        handles = [m.enqueue(tests.add_batch(n, None if n == 1 else n), retries = 1) for n in range(4)]
+        m.new_worker(dispatcher = "threads", concurrency = 1).work(interval = 0)
+        m.new_worker(dispatcher = "fork").work(interval = 0)
+
+        self.failUnlessEqual(tests.batch_sizes, [3])
+        self.failUnlessEqual([handles[n].get(5) for n in (0, 2, 3)], [0, 4, 6])
+        self.failUnlessRaises(monque.MonqueJobFailed, handles[1].get, 5)
+        self.failUnlessEqual(m.get_dead_collection('test_queue').count(), 1)
+
+        # a batch of one takes no more calls, and calls take no keywords
+        del tests.batch_sizes[:]
+        m.clear()
+
+        for n in range(2):
+            m.enqueue(tests.add_single(n, n))
+
+        m.new_worker(dispatcher = "threads", concurrency = 1).work(interval = 0)
+        self.failUnlessEqual(tests.batch_sizes, [1])
+        self.failUnlessRaises(TypeError, tests.add_batch, 1, b = 2)
+
+    def testThreadedWorker(self):
+        import tests
+
+        self.monque.clear()
+
+        tmpfiles = [tempfile.mkstemp()[1] for i in range(4)]
+        for i, tmpfile in enumerate(tmpfiles):
+            self.monque.enqueue(tests.set_test_values(tmpfile, i))
+
+        worker = self.monque.new_worker(dispatcher = "threads", concurrency = 2)
+        worker.work(interval = 0)
+        worker.work(interval = 0)
+
+        for i, tmpfile in enumerate(tmpfiles):
+            self.failUnlessEqual(do_get_test_values(tmpfile), ((i,), dict()))
+            os.unlink(tmpfile)
+
+    def testAsyncWorker(self):
+        import tests
+
+        if monque.async_worker.gevent is None:
+            self.skipTest("gevent is not installed")
+
+        args = (1,)
+        kwargs = dict(a = 2)
+
+        self.monque.clear()
+
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, *args, **kwargs))
+        worker = self.monque.new_async_worker(concurrency = 4)
+        worker.work(interval = 0)
+
+        self.failUnlessTestValuesEqual(args, kwargs)
+
+    def testBufferedStats(self):
+        import tests
+
+        self.monque.clear()
+
+        qs = self.monque.get_collection('queue_stats')
+        before = (qs.find_one(dict(queue = 'test_queue')) or dict()).get('successes', 0)
+
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 1))
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 2))
+        worker = self.monque.new_worker(stats_flush_every = 10, stats_flush_interval = 60)
+        worker.register_worker()
+        self.monque.buffer_counts(worker._stats)
+        wc = self.monque.get_collection('workers')
+
+        try:
+            self.failUnless(worker._work_once())
+            self.failUnless(worker._work_once())
+
+            # counters, queue sizes included, are held in memory until the
+            # worker flushes them
+            self.failUnlessEqual((qs.find_one(dict(queue = 'test_queue')) or dict()).get('successes', 0), before)
+            self.failUnlessEqual(wc.find_one(worker._worker_id)['processed'], 0)
+            self.failUnlessEqual(self.monque.queue_sizes(["test_queue"])["test_queue"]['ready'], 2)
+
+            worker._stats.flush()
+
+            self.failUnlessEqual(qs.find_one(dict(queue = 'test_queue'))['successes'], before + 2)
+            self.failUnlessEqual(wc.find_one(worker._worker_id)['processed'], 2)
+            self.failUnlessEqual(self.monque.queue_sizes(["test_queue"])["test_queue"]['ready'], 0)
+        finally:
+            self.monque.buffer_counts(None)
+            worker.unregister_worker()
+
+    def testMetrics(self):
+        import monque.metrics
+        import tests
+
+        self.monque.clear()
+        self.monque.get_collection('metrics').remove()
+
+        for n in range(3):
+            self.monque.enqueue(tests.add(n, n))
+
+        for n in range(3):
+            self.monque.new_worker(dispatcher = "threads", concurrency = 1).work(interval = 0)
+
+        histograms = monque.metrics.histograms(self.monque, 'run_seconds', queue = 'test_queue')
+        self.failUnlessEqual([h.count for h in histograms.values()], [3])
+
+        # run times vary by backend, so check the layout rather than the values
+        run = histograms.values()[0]
+        self.failUnless(set(run.buckets) <= set(monque.metrics.BUCKETS))
+        self.failUnlessEqual(sum(run.buckets.values()), 3)
+        self.failUnlessEqual(list(run.cumulative())[-1], (float('inf'), 3))
+
+        known = monque.metrics.MonqueHistogram()
+        for value in (0.003, 0.02, 0.02, 0.2):
+            known.observe(value)
+        self.failUnlessEqual(known.buckets, {0.005 : 1, 0.025 : 2, 0.25 : 1})
+        self.failUnlessAlmostEqual(known.quantile(0.5), 0.0175)
+
+        text = monque.metrics.render(self.monque)
+        self.failUnless('monque_job_wait_seconds_bucket{func="tests.add",queue="test_queue",le="+Inf"} 3' in text)
+        self.failUnless('monque_job_run_seconds_count{func="tests.add",queue="test_queue"} 3' in text)
+
+        merged = monque.metrics.MonqueHistogram()
+        merged.observe(0.2)
+        merged.merge(histograms.values()[0])
+        self.failUnlessEqual(merged.count, 4)
+
+    def testHooksAndProfiling(self):
+        import monque.profiling
+        import tests
+
+        events = []
+        hooks = dict(
+            before_claim    = lambda worker: events.append('before_claim'),
+            before_run      = lambda worker, order: events.append('before_run'),
+            after_run       = lambda worker, order: events.append('after_run'),
+            on_failure      = lambda worker, order, error: events.append('on_failure'),
+        )
+
+        self.monque.clear()
+        self.monque.get_collection('profiles').remove()
+
+        self.monque.enqueue(tests.add(1, 2))
+        self.monque.enqueue(tests.add(1, None))
+
+        for dispatcher in ("threads", "fork"):
+            self.monque.new_worker(dispatcher = dispatcher, concurrency = 1, hooks = hooks, profile_every = 1).work(interval = 0)
+
+        self.failUnlessEqual(events, ['before_claim', 'before_run', 'after_run', 'before_claim', 'before_run', 'on_failure'])
+
+        spots = monque.profiling.top(self.monque, 'tests.add')
+        self.failUnless([label for (label, calls, tottime, cumtime) in spots if label.endswith('(add)')])
+
+    def testPrefetchWorker(self):
+        import tests
+
+        self.monque.clear()
+
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 1))
+        self.monque.enqueue(tests.set_test_values(self.tmpfile, 2))
+        worker = self.monque.new_worker(prefetch = 2)
+        worker.work(interval = 0)
+
+        # the second prefetched job is handed back to the queue on exit
+        self.failUnless(self.monque.dequeue() is not None)
+        self.failUnlessEqual(self.monque.dequeue(), None)
+
     def testDelayedWorker(self):
         import tests
         